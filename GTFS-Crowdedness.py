@@ -3,11 +3,19 @@ import sys
 import requests
 import zipfile
 import pandas as pd
-from geojson import LineString, Feature, FeatureCollection, dump
+import numpy as np
+from GTFS import GTFS
+from GTFSPositions import parallel_trip_positions
+from GTFSGeoJSON import GeoJSONWriter, segments
 
 GTFSDIR = 'gtfs-nl'    # https://transitfeeds.com/p/ov/814/20190705
 NDOVDIR = 'ndov'
 displaydate = '20210309'
+# Export newline-delimited GeoJSON (.ndjson) instead of a FeatureCollection
+NDJSON = False
+# Agencies to show. The seats per wagon type below only cover the NS trains and the stop code filter
+# is only checked for them, add 'ARR', 'CXX', 'KEOLIS' or 'SYNTUS' once their vehicle types are covered
+AGENCYNAMES = ['NS']
 
 
 def min2str(minutes):
@@ -64,10 +72,11 @@ def get_crowdedness_operator(operatorcode, type, date):
 ########################################################################################################
 ############################### READ CROWDEDNESS INFORMATION ###########################################
 ########################################################################################################
-druktedata = get_crowdedness_operator('ns', 'csv.gz', displaydate)
-# druktedata = druktedata.append(get_crowdedness_operator('arr', 'zip', displaydate))
-# druktedata = druktedata.append(get_crowdedness_operator('cxx', 'csv.gz', displaydate))
-# druktedata = druktedata.append(get_crowdedness_operator('keolis', 'csv.zip', displaydate)) # includes 'Syntus'
+# Operator code, file type and agencies of the crowdedness files, only those of AGENCYNAMES are read
+OPERATORS = [('ns', 'csv.gz', ['NS']), ('arr', 'zip', ['ARR']), ('cxx', 'csv.gz', ['CXX']),
+             ('keolis', 'csv.zip', ['KEOLIS', 'SYNTUS'])]
+druktedata = pd.concat([get_crowdedness_operator(code, type, displaydate) for code, type, names in OPERATORS
+                        if set(names) & set(AGENCYNAMES)], ignore_index=True)
 druktedata = druktedata[['DataOwnerCode', 'JourneyNumber', 'OperatingDay', 'UserStopCodeBegin', 
                          'UserStopCodeEnd', 'VehicleType', 'TotalNumberOfCoaches', 'Occupancy']]
 druktedata.columns=['operator', 'ritnumber', 'date', 'departure', 'arrival', 'wagontype', 'coaches', 'classification']
@@ -97,8 +106,8 @@ def read_csv(csvfile):
         with z.open(csvfile) as f:
             return pd.read_csv(f)
 
-#AGENCYNAMES = ['NS', 'ARR', 'CXX', 'KEOLIS', 'SYNTUS']
-AGENCYNAMES = ['NS']
+# Worker processes for the trip positions
+WORKERS = os.cpu_count()
 agencies = read_csv('agency.txt')
 agency_ids = agencies[agencies.agency_name.isin(AGENCYNAMES)]['agency_id'].values
 agencies = agencies[agencies.agency_name.isin(AGENCYNAMES)][['agency_id', 'agency_name']]
@@ -137,7 +146,7 @@ stops = stops_full[stops_full.stop_id.isin(stop_ids)].copy()
 
 # Now add the stopareas (stations)
 stopareas = stops.parent_station.unique()
-stops = stops.append(stops_full[stops_full.stop_id.isin(stopareas)].copy())
+stops = pd.concat([stops, stops_full[stops_full.stop_id.isin(stopareas)]])
 
 stops.zone_id = stops.zone_id.str.replace('IFF:', '').str.upper()
 stops.stop_code = stops.stop_code.str.upper()
@@ -146,93 +155,20 @@ stops = stops[['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'parent_station',
 stops.loc[stops['zone_id'].isnull(),'zone_id'] = stops['stop_code']
 stops.loc[stops['stop_code'].isnull(),'stop_code'] = stops['zone_id']
 
-# shapes = pd.read_csv(os.path.join(GTFSDIR, 'shapes.txt'))
-shapes = read_csv('shapes.txt')
+# The shapes are memory-mapped from a store that is only built when shapes.txt changed
+shape_geometry = GTFS(verbose=False).shape_store(os.path.join(GTFSDIR, 'gtfs-nl.zip'),
+                                                 os.path.join(GTFSDIR, 'shapes.bin'))
 
 
 ########################################################################################################
 ################### DETERMINE FOR ALL TRIPS FOR EVERY MINUTE THE LOCATION ##############################
 ########################################################################################################
-def interpolate_lat_lon(tripshape, dist):
-        ps = tripshape[tripshape['shape_dist_traveled'].le(dist)].index[-1]
-        ns = tripshape[tripshape['shape_dist_traveled'].ge(dist)].index[0]
-        lat1 = tripshape[tripshape.index == ps].iloc[0]['shape_pt_lat']
-        lon1 = tripshape[tripshape.index == ps].iloc[0]['shape_pt_lon']
-        lat2 = tripshape[tripshape.index == ns].iloc[0]['shape_pt_lat']
-        lon2 = tripshape[tripshape.index == ns].iloc[0]['shape_pt_lon']
-        dst1 = tripshape[tripshape.index == ps].iloc[0]['shape_dist_traveled']
-        dst2 = tripshape[tripshape.index == ns].iloc[0]['shape_dist_traveled']
-        prc = ((dist - dst1) / (dst2 - dst1)) if dst2 != dst1 else 1
-        lat = lat1 + prc * (lat2 - lat1)
-        lon = lon1 + prc * (lon2 - lon1)
-        return lat, lon
-
-def get_trip_data(ritnumber, ritdate):
-    trip = trips[(trips.trip_short_name == ritnumber) & (trips.date == ritdate)].iloc[0]
-    tripid = trip['trip_id']
-    shapeid = trip['shape_id']
-    tripshape = shapes[shapes.shape_id == shapeid]
-    tripstops = stoptimes[stoptimes.trip_id == tripid].sort_values('stop_sequence')
-
-    lastdep = -1
-    lastdist= -1
-    seq = 0
-    dl = []
-
-    for position in tripstops.iterrows():
-        arr = position[1][3]
-        dep = position[1][4]
-        dist = position[1][5]
-        dist = dist + 0.1 if dist == lastdist else dist
-        arr = arr + 1 if arr == lastdep else arr
-        stop = position[1][2]
-        if (dist == dist) & (arr == arr):
-            if lastdep > 0:
-                seq = seq+1
-                stepsize = ((dist-lastdist) / (arr-lastdep))
-                for t in range(lastdep+1, arr):
-                    dst = int(lastdist + ( (t - lastdep) * stepsize))
-                    # prc = (dst - lastdist) / (dist - lastdist)
-                    lat, lon = interpolate_lat_lon(tripshape, dst)
-                    # lat, lon = interpolate_lat_lon(tripshape, dst, prc)
-                    # print('{:2d}: {:4d} - {:4.2f} - {:8d} - ({:6.4f} , {:6.4f})'.format(seq, t, prc, dst, lat, lon))
-                    dl.append({'trip_id': tripid, 'time': int(t), 'lat': lat, 'lon': lon, 'stop_id': stop,
-                                    'ritnumber' : ritnumber, 'sequence' : seq})
-            seq = seq+1
-            for t in range(arr, dep+1):
-                dst = int(dist)
-                # prc = 1
-                lat, lon = interpolate_lat_lon(tripshape, dst)
-                # lat, lon = interpolate_lat_lon(tripshape, dst, prc)
-                dl.append({'trip_id': tripid, 'time': int(t), 'lat': lat, 'lon': lon, 'stop_id': stop,
-                                'ritnumber' : ritnumber, 'sequence' : seq})
-            lastdep = dep
-            lastdist = dist
-    df = pd.DataFrame(dl)
-    if 'trip_id' in df.columns :
-        df.trip_id = df.trip_id.astype(int)
-        df.sequence = df.sequence.astype(int)
-        df.time = df.time.astype(int)
-        df.ritnumber = df.ritnumber.astype(int)
-        df.stop_id = df.stop_id.astype(int).astype(str)
-        df = df[['trip_id', 'ritnumber', 'sequence', 'time', 'stop_id', 'lat', 'lon']]
-#         df = df.merge(stops[['stop_id', 'stop_code', 'stop_name']])
-        return df
-    else:
-        return None
-
-timedata = pd.DataFrame()
 mask1 = (trips.trip_short_name > 0) & (trips.trip_short_name < 999999)
 # mask1 = (trips.trip_short_name > 3000) & (trips.trip_short_name < 4000)
 mask2 = trips.date == displaydate
-total = len(trips[mask1 & mask2].trip_short_name.unique())
-i = 0
-for r in trips[mask1 & mask2].trip_short_name.unique():
-    df_tmp = get_trip_data(ritnumber = r, ritdate = displaydate)
-    if df_tmp is not None:
-        timedata = timedata.append(df_tmp)
-        update_progress(i, total=total, barLength=50)
-    i += 1
+# One trip per ritnumber, the positions of all trips of the day are computed in parallel batches
+daytrips = trips[mask1 & mask2].drop_duplicates('trip_short_name')
+timedata = parallel_trip_positions(daytrips, stoptimes, shape_geometry, step=1, workers=WORKERS)
 timedata = timedata.merge(stops[['stop_id', 'stop_code', 'stop_name']])
 
 
@@ -251,29 +187,20 @@ timedata['elevation'] = 0
 ########################################################################################################
 ################################ EXPORT GEOJSON FOR ANIMATION #########################################
 ########################################################################################################
-features=[]
-total = len(timedata.ritnumber.unique())
-i=0
-for rn in timedata.ritnumber.unique():
-    i+= 1
-    total_trip = timedata[timedata.ritnumber == rn].dropna()
-    for sq in total_trip.sequence.unique():
-        trip = total_trip[total_trip.sequence == sq]
-        tripfirst = trip.iloc[0]
-        triplast = trip.iloc[-1]
-        name = str(tripfirst["ritnumber"]) + " : " + tripfirst["stop_code"] + " - " + triplast["stop_code"]
-        features.append(
-            Feature(geometry=LineString(trip[['lon', 'lat', 'elevation', 'timestamp']].to_numpy().tolist()) ,
-                                        properties=dict(label=str(tripfirst["ritnumber"]),
-                                                        name=name,
-                                                        capacity=str(tripfirst["seats"]),
-                                                        passengers=str(tripfirst["passengers"]),
-                                                        crowding=str(tripfirst["classification"])))    
-        )
-    update_progress(i, total=total, barLength=50) 
-
-with open('trainpag.geojson', 'w') as outfile:
-        dump(FeatureCollection(features), outfile)
+# Group the positions once per ritnumber and sequence, every segment becomes a feature
+timedata = timedata.dropna()
+order, bounds = segments(timedata, ['ritnumber', 'sequence'])
+timedata = timedata.iloc[order]
+first, last = timedata.iloc[bounds[:-1]], timedata.iloc[bounds[1:] - 1]
+properties = pd.DataFrame({'label': first.ritnumber.astype(str).to_numpy(),
+                           'name': (first.ritnumber.astype(str) + ' : ' + first.stop_code).to_numpy() + ' - ' +
+                                   last.stop_code.to_numpy(),
+                           'capacity': first.seats.astype(str).to_numpy(),
+                           'passengers': first.passengers.astype(str).to_numpy(),
+                           'crowding': first.classification.astype(str).to_numpy()})
+
+with GeoJSONWriter('trainpag.ndjson' if NDJSON else 'trainpag.geojson', ndjson=NDJSON) as writer:
+    writer.write_lines(timedata[['lon', 'lat', 'elevation', 'timestamp']].to_numpy(), bounds, properties)
 
         
 ########################################################################################################
@@ -282,17 +209,8 @@ with open('trainpag.geojson', 'w') as outfile:
 network = trips.drop_duplicates('route_id').dropna()
 network = network[~(network.trip_long_name == 'Stopbus i.p.v. trein')]
 
-features=[]
-total = len(network.shape_id.unique())
-i=0
-for si in network.shape_id.unique():
-    i+= 1
-    section = shapes[shapes.shape_id == si]
-    features.append(
-        Feature(geometry=LineString(section[['shape_pt_lon', 'shape_pt_lat']].to_numpy().tolist()) ,
-                                    properties=dict(label=str(si)))
-    )
-    update_progress(i, total=total, barLength=50) 
-
-with open('network.geojson', 'w') as outfile:
-        dump(FeatureCollection(features), outfile)
+with GeoJSONWriter('network.ndjson' if NDJSON else 'network.geojson', ndjson=NDJSON) as writer:
+    for si in network.shape_id.unique():
+        if si in shape_geometry.shape_ids:
+            lat, lon, _ = shape_geometry.points(si)
+            writer.write_line(np.column_stack([lon, lat]), dict(label=str(si)))
@@ -1,27 +1,864 @@
 import os
+import json
+import time
 import zipfile
+import threading
+import tracemalloc
+import hashlib
+import unicodedata
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import urllib.request
-import gtfs_realtime_OVapi_pb2  # Neccessary to find additional field of OVapi
-import gtfs_realtime_pb2
-from protobuf_to_dict import protobuf_to_dict
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.feather as feather
+import requests
+from array import array
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from email.utils import formatdate
+from functools import lru_cache
+
+
+def gtfs_time_to_seconds(times):
+    """
+    Convert a column of GTFS "HH:MM:SS" strings to seconds since the start of the service day.
+    Times past midnight (hour >= 24) are kept, malformed or missing values become NaN.
+    Every distinct value is parsed only once, stop_times holds far fewer distinct times than rows.
+
+    :param times: Series or array with time strings
+    :return: float64 numpy array with seconds
+    """
+    codes, uniques = pd.factorize(np.asarray(times, dtype=object))
+    parts = pd.Series(uniques, dtype=object).astype(str).str.strip().str.split(':', expand=True)
+    parts = parts.reindex(columns=range(max(parts.shape[1], 3)))
+    hms = parts.iloc[:, :3].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    valid = (hms[:, 1] < 60) & (hms[:, 2] < 60) & (hms >= 0).all(axis=1) & parts.iloc[:, 3:].isna().all(axis=1)
+    seconds = np.where(valid, hms[:, 0] * 3600 + hms[:, 1] * 60 + hms[:, 2], np.nan)
+    return np.where(codes >= 0, seconds[codes], np.nan)
+
+
+def dictionary_take(column, values, missing):
+    """
+    Expand values given per dictionary entry of a dictionary encoded arrow column to the rows of the column
+
+    :param column: pyarrow DictionaryArray
+    :param values: numpy array with a value per dictionary entry
+    :param missing: Value for missing entries
+    :return: numpy array with a value per row
+    """
+    indices = pc.fill_null(column.indices, len(column.dictionary)).to_numpy()
+    return np.append(values, np.array([missing], dtype=values.dtype))[indices]
+
+
+def fold_name(name):
+    """
+    Normalize a stop name for case and accent insensitive comparison
+    """
+    name = unicodedata.normalize('NFKD', str(name))
+    return ''.join(c for c in name if not unicodedata.combining(c)).casefold()
+
+
+def trigram_index(keys):
+    """
+    Posting lists of the trigrams (substrings of three characters) of keys
+
+    :param keys: Array with strings
+    :return: Dictionary with per trigram the sorted positions of the keys holding it
+    """
+    trigrams, positions = [], []
+    for position, key in enumerate(keys):
+        found = {key[i:i + 3] for i in range(len(key) - 2)}
+        trigrams.extend(found)
+        positions.extend([position] * len(found))
+    codes, uniques = pd.factorize(pd.Series(trigrams, dtype=object))
+    positions = np.asarray(positions, dtype=np.intp)
+    order = np.lexsort((positions, codes))
+    bounds = np.searchsorted(codes[order], np.arange(1, len(uniques)))
+    return dict(zip(uniques, np.split(positions[order], bounds)))
+
+
+class StopNameIndex:
+    """
+    Index on stop names for exact, prefix and substring lookups, optionally case and accent insensitive.
+    Lookups work on the distinct names (sorted for exact and prefix searches) and results are cached,
+    so repeated lookups for departure boards do not scan all stops. Substring lookups intersect the
+    posting lists of the trigrams of the searched name and only check the names found.
+    """
+
+    def __init__(self, names):
+        codes, uniques = pd.factorize(pd.Series(names, dtype=object).fillna(''))
+        # Row positions grouped per distinct name
+        self.positions = np.argsort(codes, kind='stable')
+        self.bounds = np.searchsorted(codes[self.positions], np.arange(len(uniques) + 1))
+        uniques = np.asarray(uniques, dtype=object)
+        folded = np.array([fold_name(n) for n in uniques], dtype=object)
+        order = np.argsort(uniques)
+        self.keys, self.key_ids = uniques[order], order
+        order = np.argsort(folded)
+        self.folded_keys, self.folded_key_ids = folded[order], order
+        # Trigram posting lists of the keys and of the folded keys, built on the first substring lookup
+        self.trigrams = {}
+        self.lookup = lru_cache(maxsize=4096)(self._lookup)
+
+    def substring_candidates(self, keys, name, fold):
+        """
+        Sorted positions of the keys holding all trigrams of name, all keys if name is shorter than a trigram
+        """
+        if len(name) < 3:
+            return np.arange(len(keys))
+        if fold not in self.trigrams:
+            self.trigrams[fold] = trigram_index(keys)
+        postings = [self.trigrams[fold].get(name[i:i + 3]) for i in range(len(name) - 2)]
+        if any(p is None for p in postings):
+            return np.array([], dtype=np.intp)
+        postings.sort(key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        return candidates
+
+    def _lookup(self, name, mode='exact', fold=False):
+        """
+        Find the stops with a matching name
+
+        :param str name: The (part of the) name to look for
+        :param str mode: 'exact', 'prefix' or 'substring'
+        :param bool fold: Ignore case and accents
+        :return: Sorted array with row positions of the matching stops
+        """
+        keys, ids = (self.folded_keys, self.folded_key_ids) if fold else (self.keys, self.key_ids)
+        name = fold_name(name) if fold else name
+        if mode == 'exact':
+            ids = ids[np.searchsorted(keys, name, 'left'):np.searchsorted(keys, name, 'right')]
+        elif mode == 'prefix':
+            ids = ids[np.searchsorted(keys, name, 'left'):np.searchsorted(keys, name + '\U0010ffff', 'left')]
+        elif mode == 'substring':
+            candidates = self.substring_candidates(keys, name, fold)
+            ids = ids[candidates[np.fromiter((name in keys[c] for c in candidates), dtype=bool,
+                                             count=len(candidates))]]
+        else:
+            raise ValueError('Unknown lookup mode {}'.format(mode))
+        if len(ids) == 0:
+            return np.array([], dtype=np.intp)
+        return np.sort(np.concatenate([self.positions[self.bounds[i]:self.bounds[i + 1]] for i in ids]))
+
+
+REALTIME_FEEDS = ['tripUpdates', 'trainUpdates', 'vehiclePositions', 'alerts']
+
+# Frames holding the decoded rows of every realtime feed
+REALTIME_FRAMES = {'tripUpdates': ['trip_updates'], 'trainUpdates': ['train_updates'],
+                   'vehiclePositions': ['vehicle_positions'],
+                   'alerts': ['alerts', 'alerts_to_stops', 'alerts_to_routes']}
+
+# Outcome of a download, status is 'cached', 'not_modified', 'downloaded' or 'error'
+FetchResult = namedtuple('FetchResult', ['url', 'filename', 'status', 'error'])
+
+TIMEZONE = 'Europe/Amsterdam'
+
+# Names of the GTFS-realtime StopTimeUpdate schedule relationships, by value. A cancelled trip
+# (TripDescriptor.schedule_relationship CANCELED) cancels all its stops.
+STOP_RELATIONSHIPS = np.array(['SCHEDULED', 'SKIPPED', 'NO_DATA'], dtype=object)
+TRIP_CANCELED = 3
+
+
+def realtime_modules():
+    """
+    The GTFS-realtime protobuf modules, imported on first use of a realtime feature. Importing the
+    OVapi module registers its extensions, which is necessary to parse them.
+
+    :return: Tuple with gtfs_realtime_pb2 and gtfs_realtime_OVapi_pb2
+    """
+    import gtfs_realtime_pb2
+    import gtfs_realtime_OVapi_pb2
+    return gtfs_realtime_pb2, gtfs_realtime_OVapi_pb2
+
+
+def field(message, name, default=None):
+    """
+    Value of an optional protobuf field, default if the field (or the message) is not set
+    """
+    return getattr(message, name) if message is not None and message.HasField(name) else default
+
+
+def append_stop_time_event(columns, event, stop_time_update):
+    """
+    Append time and delay of the arrival or departure of a stop time update to the column buffers
+    """
+    ste = getattr(stop_time_update, event) if stop_time_update.HasField(event) else None
+    columns[event + '_time'].append(field(ste, 'time', np.nan))
+    columns[event + '_delay'].append(field(ste, 'delay', np.nan))
+
+
+def schedule_relationships(trips, stops):
+    """
+    Schedule relationship of every stop time update from the trip and stop time update values,
+    CANCELED for all stops of a cancelled trip
+    """
+    names = STOP_RELATIONSHIPS[np.asarray(stops, dtype=np.int64)]
+    names[np.asarray(trips, dtype=np.int64) == TRIP_CANCELED] = 'CANCELED'
+    return names
+
+
+def repeat(values, counts):
+    """
+    Repeat per entity values for every row of the entity
+    """
+    return np.repeat(np.asarray(values, dtype=object if isinstance(values, list) else None),
+                     np.asarray(counts, dtype=np.int64))
+
+
+def nullable_int(values):
+    """
+    Convert a buffer of doubles, NaN for missing values, to a nullable integer column
+    """
+    return pd.array(np.asarray(values, dtype=float), dtype='Float64').astype('Int64')
+
+
+def epoch_to_datetime(seconds):
+    """
+    Convert POSIX timestamps (NaN for missing values) to naive local datetimes in one go
+    """
+    return pd.to_datetime(np.asarray(seconds, dtype=float), unit='s', utc=True).tz_convert(TIMEZONE).tz_localize(None)
+
+
+def service_datetime(dates, times):
+    """
+    Combine GTFS service dates (YYYYMMDD) and times (HH:MM:SS, may be past 24:00) to datetimes in one go
+    """
+    dates = pd.to_datetime(pd.Series(dates, dtype=object), format='%Y%m%d', errors='coerce')
+    return (dates + pd.to_timedelta(gtfs_time_to_seconds(times), unit='s')).to_numpy()
+
+
+class AlertIndex:
+    """
+    Index on the active periods of alerts per stop or route. The periods are sorted per stop (or route)
+    on start time, so the alerts active for a stop at a given time are found without scanning all alerts.
+    A period without start is active from the earliest time, as GTFS-realtime defines.
+    """
+
+    def __init__(self, mapping, column):
+        """
+        :param mapping: alerts_to_stops or alerts_to_routes
+        :param str column: stop_id or route_id
+        """
+        ids = pd.Categorical(mapping[column])
+        self.dtype = ids.dtype
+        codes = ids.codes
+        starts = mapping.start.to_numpy()
+        starts = np.where(np.isnat(starts), np.array(np.iinfo(np.int64).min + 1).view(starts.dtype), starts)
+        order = np.lexsort((starts, codes))
+        self.alert_ids = mapping.alert_id.to_numpy()[order]
+        self.starts = starts[order]
+        self.ends = mapping.end.to_numpy()[order]
+        self.bounds = np.searchsorted(codes[order], np.arange(len(self.dtype.categories) + 1))
+
+    def active(self, ids, at):
+        """
+        Alerts active at a moment for any of the given stops (or routes)
+
+        :param ids: The stop_ids or route_ids
+        :param datetime at: The moment
+        :return: Array with the distinct alert ids
+        """
+        at = np.datetime64(at).astype(self.starts.dtype)
+        codes = pd.Categorical(ids, dtype=self.dtype).codes
+        found = []
+        for c in np.unique(codes[codes >= 0]):
+            lo, hi = self.bounds[c], self.bounds[c + 1]
+            hi = lo + np.searchsorted(self.starts[lo:hi], at, 'right')
+            ends = self.ends[lo:hi]
+            found.append(self.alert_ids[lo:hi][np.isnat(ends) | (ends >= at)])
+        return np.unique(np.concatenate(found)) if found else np.array([], dtype=object)
+
+
+def forward_fill(values, starts):
+    """
+    Carry the last known (not NaN) value forward within groups of consecutive rows
+
+    :param values: float array, NaN for unknown values
+    :param starts: bool array, True for the first row of every group
+    :return: float array with the unknown values filled, NaN before the first known value of a group
+    """
+    last = np.where(~np.isnan(values) | starts, np.arange(len(values)), 0)
+    np.maximum.accumulate(last, out=last)
+    return values[last]
+
+
+class TripStopIndex:
+    """
+    Positional index on (trip_id, stop_sequence) of a stop times frame. Realtime rows are matched with
+    stop times by binary search on a combined key instead of a merge, and the stop times of every trip
+    are available in stop sequence order, e.g. to carry delays forward to the following stops.
+    """
+
+    def __init__(self, trip_ids, stop_sequences):
+        """
+        :param trip_ids: Categorical trip_id column of the frame
+        :param stop_sequences: stop_sequence column of the frame
+        """
+        self.dtype = trip_ids.dtype
+        codes = trip_ids.cat.codes.to_numpy().astype(np.int64)
+        sequences = np.asarray(stop_sequences, dtype=np.int64)
+        # Row positions in (trip, stop_sequence) order
+        self.order = np.lexsort((sequences, codes))
+        self.keys = self.key(codes[self.order], sequences[self.order])
+        codes = codes[self.order]
+        self.starts = np.concatenate([[True], codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=bool)
+
+    @staticmethod
+    def key(codes, sequences):
+        return (codes << 32) | sequences
+
+    def lookup(self, trip_ids, stop_sequences):
+        """
+        Row positions of the stop times of the given (trip_id, stop_sequence) pairs
+
+        :param trip_ids: The trip_ids
+        :param stop_sequences: The stop sequences, may contain missing values
+        :return: Row positions, -1 for pairs without stop time
+        """
+        codes = pd.Categorical(trip_ids, dtype=self.dtype).codes.astype(np.int64)
+        sequences = pd.to_numeric(pd.Series(stop_sequences), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        valid = (codes >= 0) & ~np.isnan(sequences) & (sequences >= 0)
+        keys = self.key(codes, np.where(valid, sequences, 0).astype(np.int64))
+        found = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        valid &= len(self.keys) > 0
+        valid[valid] &= self.keys[found[valid]] == keys[valid]
+        return np.where(valid, self.order[found] if len(self.keys) else -1, -1)
+
+    def propagate(self, *columns):
+        """
+        Carry the last known value of every trip forward to its following stops. With several columns
+        (e.g. arrival and departure delay) values are carried forward in column order within a stop.
+
+        :param columns: float arrays with a value per row of the frame, NaN for unknown values
+        :return: Tuple with a float array per column
+        """
+        values = np.column_stack([np.asarray(c, dtype=float)[self.order] for c in columns])
+        starts = np.zeros(values.shape, dtype=bool)
+        starts[:, 0] = self.starts
+        filled = np.empty_like(values)
+        filled[self.order] = forward_fill(values.ravel(), starts.ravel()).reshape(values.shape)
+        return tuple(filled.T)
+
+
+# First bytes of a file written by ShapeGeometry.save
+SHAPE_STORE_MAGIC = b'GTFSSHAPES1'
+
+
+class ShapeGeometry:
+    """
+    The points of all shapes in contiguous arrays, ordered by shape and point sequence, with the offset
+    of the first point of every shape. The distances along a shape are shifted per shape onto one
+    increasing axis, so positions for any number of (shape, distance) pairs are interpolated with one
+    binary search instead of filtering the shape points per position.
+    """
+
+    def __init__(self, shape_ids, offsets, lat, lon, dist):
+        """
+        :param shape_ids: The shape ids, sorted
+        :param offsets: Position of the first point of every shape, followed by the number of points
+        :param lat: Latitude of every point
+        :param lon: Longitude of every point
+        :param dist: shape_dist_traveled of every point
+        """
+        self.shape_ids = pd.Index(shape_ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lat, self.lon, self.dist = lat, lon, dist
+        lengths = np.diff(self.offsets)
+        dist = np.asarray(dist, dtype=float)
+        self.first = dist[self.offsets[:-1]]
+        self.last = dist[self.offsets[1:] - 1]
+        # Shape k covers [base_k + first_k, base_k + last_k] of the combined axis, shapes 1 meter apart
+        spans = np.maximum(self.last - self.first, 0) + 1
+        self.base = np.concatenate([[0], np.cumsum(spans)[:-1]]) - self.first
+        self.axis = np.maximum.accumulate(dist + np.repeat(self.base, lengths)) if len(dist) else dist
+
+    @classmethod
+    def from_frame(cls, shapes, dtype=float):
+        """
+        Build from a shapes.txt frame
+
+        :param shapes: Frame with shape_id, shape_pt_sequence, shape_pt_lat, shape_pt_lon and shape_dist_traveled
+        :param dtype: Type of the latitude, longitude and distance arrays
+        """
+        shapes = shapes.sort_values(['shape_id', 'shape_pt_sequence'])
+        shape_ids, starts = np.unique(shapes.shape_id.to_numpy(), return_index=True)
+        return cls(shape_ids, np.append(starts, len(shapes)), shapes.shape_pt_lat.to_numpy(dtype=dtype),
+                   shapes.shape_pt_lon.to_numpy(dtype=dtype), shapes.shape_dist_traveled.to_numpy(dtype=dtype))
+
+    def save(self, filename, key=None):
+        """
+        Store the arrays in one file that open memory-maps: a JSON header with the stage key and the type,
+        shape and position of every array, followed by the arrays aligned on 64 bytes
+
+        :param str filename: The file
+        :param str key: Stage key recorded in the file, see GTFS.stage_key
+        """
+        arrays = {name: values.astype(str) if values.dtype == object else np.ascontiguousarray(values)
+                  for name, values in self.arrays().items()}
+        header, position = {'key': key, 'arrays': {}}, 0
+        for name, values in arrays.items():
+            header['arrays'][name] = {'dtype': values.dtype.str, 'shape': values.shape, 'offset': position}
+            position += -(-values.nbytes // 64) * 64
+        encoded = json.dumps(header).encode()
+        start = -(-(len(SHAPE_STORE_MAGIC) + 8 + len(encoded)) // 64) * 64
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(SHAPE_STORE_MAGIC + len(encoded).to_bytes(8, 'little') + encoded)
+            for name, values in arrays.items():
+                f.seek(start + header['arrays'][name]['offset'])
+                f.write(values.tobytes())
+            f.truncate(start + position)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def read_header(filename):
+        """
+        The header of a file written by save and the position of the first array, None if there is
+        no (valid) file
+        """
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            if f.read(len(SHAPE_STORE_MAGIC)) != SHAPE_STORE_MAGIC:
+                return None
+            size = int.from_bytes(f.read(8), 'little')
+            try:
+                header = json.loads(f.read(size))
+            except ValueError:
+                return None
+        return header, -(-(len(SHAPE_STORE_MAGIC) + 8 + size) // 64) * 64
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Geometry on the arrays of a file written by save. The arrays are memory-mapped read-only, so
+        opening is immediate, processes share the pages and the points of a shape are views on the file.
+        """
+        header, start = cls.read_header(filename)
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            arrays[name] = np.memmap(filename, dtype=spec['dtype'], mode='r', offset=start + spec['offset'],
+                                     shape=shape) if np.prod(shape) else np.empty(shape, dtype=spec['dtype'])
+        return cls.from_arrays(arrays)
+
+    def arrays(self):
+        """
+        The arrays of the geometry, including the derived ones, e.g. to share them with other processes
+        """
+        return {'shape_ids': self.shape_ids.to_numpy(), 'offsets': self.offsets, 'lat': self.lat, 'lon': self.lon,
+                'dist': self.dist, 'first': self.first, 'last': self.last, 'base': self.base, 'axis': self.axis}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Geometry on the arrays returned by arrays(), e.g. memory-mapped, without copying or deriving them
+        """
+        geometry = cls.__new__(cls)
+        geometry.__dict__.update(arrays)
+        geometry.shape_ids = pd.Index(arrays['shape_ids'])
+        return geometry
+
+    def points(self, shape_id):
+        """
+        Latitudes, longitudes and distances of the points of a shape, views on the arrays
+        """
+        k = self.shape_ids.get_loc(shape_id)
+        part = slice(self.offsets[k], self.offsets[k + 1])
+        return self.lat[part], self.lon[part], self.dist[part]
+
+    def interpolate(self, shape_ids, distances):
+        """
+        Positions at distances along shapes, linear between the shape points. Distances before the first
+        or after the last point of a shape give that point.
+
+        :param shape_ids: Shape id per position
+        :param distances: Distance (shape_dist_traveled) per position
+        :return: Tuple of latitude and longitude arrays, NaN for unknown shapes
+        """
+        k = self.shape_ids.get_indexer(pd.Index(shape_ids))
+        if not len(self.shape_ids):
+            return np.full(len(k), np.nan), np.full(len(k), np.nan)
+        valid = k >= 0
+        k = np.where(valid, k, 0)
+        first, last = self.offsets[k], self.offsets[k + 1] - 1
+        key = np.clip(np.asarray(distances, dtype=float), self.first[k], self.last[k]) + self.base[k]
+        previous = np.clip(np.searchsorted(self.axis, key, 'right') - 1, first, last)
+        following = np.minimum(previous + 1, last)
+        d1, d2 = self.axis[previous], self.axis[following]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(d2 > d1, (key - d1) / (d2 - d1), 0)
+        lat1, lat2 = np.asarray(self.lat[previous], dtype=float), np.asarray(self.lat[following], dtype=float)
+        lon1, lon2 = np.asarray(self.lon[previous], dtype=float), np.asarray(self.lon[following], dtype=float)
+        lat = np.where(valid, lat1 + fraction * (lat2 - lat1), np.nan)
+        lon = np.where(valid, lon1 + fraction * (lon2 - lon1), np.nan)
+        return lat, lon
+
+
+def project(lon, lat):
+    """
+    Project WGS84 coordinates to meters with an equirectangular projection around the center of the
+    Netherlands, accurate enough for distances within the country
+    """
+    x = np.asarray(lon, dtype=float) * 111320 * np.cos(np.radians(52.1))
+    y = np.asarray(lat, dtype=float) * 110574
+    return x, y
+
+
+class SpatialIndex:
+    """
+    STRtree on point locations (projected to meters) for bounding box, radius and nearest neighbour
+    queries. Results are row positions in the frame the index was built for.
+    """
+
+    def __init__(self, lon, lat, positions=None):
+        """
+        :param lon: Longitudes of the points
+        :param lat: Latitudes of the points
+        :param positions: Row positions of the points in their frame, defaults to 0..n-1
+        """
+        import shapely
+        x, y = project(lon, lat)
+        positions = np.arange(len(x)) if positions is None else np.asarray(positions)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        self.positions = positions[valid]
+        self.points = shapely.points(x[valid], y[valid])
+        self.tree = shapely.STRtree(self.points)
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        Positions of the points within a bounding box
+        """
+        import shapely
+        x1, y1 = project(min_lon, min_lat)
+        x2, y2 = project(max_lon, max_lat)
+        return np.sort(self.positions[self.tree.query(shapely.box(x1, y1, x2, y2))])
+
+    def within(self, lon, lat, radius):
+        """
+        Positions and distances (in meters) of the points within radius meters, nearest first
+        """
+        import shapely
+        point = shapely.points(*project(lon, lat))
+        found = self.tree.query(point, predicate='dwithin', distance=radius)
+        distances = shapely.distance(self.points[found], point)
+        order = np.argsort(distances, kind='stable')
+        return self.positions[found[order]], distances[order]
+
+    def nearest(self, lon, lat, k=1, max_distance=None):
+        """
+        Positions and distances (in meters) of the k nearest points, nearest first
+        """
+        import shapely
+        point = shapely.points(*project(lon, lat))
+        found, distance = self.tree.query_nearest(point, max_distance=max_distance, return_distance=True)
+        if len(distance) == 0:
+            return self.positions[[]], distance
+        # Grow the search radius from the nearest point until k points are found
+        radius = max(distance[0], 100)
+        while True:
+            positions, distances = self.within(lon, lat, radius)
+            if len(positions) >= k or len(positions) == len(self.positions) or \
+                    (max_distance is not None and radius >= max_distance):
+                break
+            radius = radius * 2 if max_distance is None else min(radius * 2, max_distance)
+        keep = distances <= max_distance if max_distance is not None else slice(None)
+        return positions[keep][:k], distances[keep][:k]
+
+    def snap(self, lon, lat, max_distance=None):
+        """
+        Nearest point for each of a set of locations in one go
+
+        :return: Positions (-1 if nothing within max_distance) and distances (NaN) per location
+        """
+        import shapely
+        x, y = project(lon, lat)
+        result = np.full(len(x), -1)
+        distances = np.full(len(x), np.nan)
+        valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+        (source, found), distance = self.tree.query_nearest(shapely.points(x[valid], y[valid]), all_matches=False,
+                                                            max_distance=max_distance, return_distance=True)
+        result[valid[source]] = self.positions[found]
+        distances[valid[source]] = distance
+        return result, distances
+
+
+# Entity ids per realtime feed that are new, changed or no longer present compared to the previous feed
+ChangeSet = namedtuple('ChangeSet', ['inserted', 'changed', 'removed'])
+
+
+class RealtimeState:
+    """
+    The decoded rows of one realtime feed, kept up to date entity by entity. A new feed is compared with
+    the previous one on the version of every feed entity (see entity_version) and only new and changed
+    entities are decoded, rows of changed and removed entities are dropped. Rows of unchanged entities
+    are kept as they are, including the feed timestamp they were decoded with.
+    """
+
+    def __init__(self, decode, keys):
+        """
+        :param decode: Function decoding feed entities and the feed timestamp to a frame, or a tuple of frames
+        :param list keys: Per decoded frame the column holding the feed entity id
+        """
+        self.decode = decode
+        self.keys = keys
+        self.versions = {}
+        self.frames = None
+        self.timestamp = None
+
+    def update(self, feed):
+        """
+        Apply a new feed to the state
+
+        :param feed: FeedMessage
+        :return: ChangeSet with the inserted, changed and removed entity ids
+        """
+        entities = {entity.id: entity for entity in feed.entity}
+        versions = {eid: entity_version(entity) for eid, entity in entities.items()}
+        inserted = [eid for eid in versions if eid not in self.versions]
+        changed = [eid for eid, version in versions.items() if eid in self.versions and self.versions[eid] != version]
+        removed = [eid for eid in self.versions if eid not in versions]
+
+        if self.frames is None or inserted or changed or removed:
+            decoded = self.decode([entities[eid] for eid in inserted + changed], feed.header.timestamp)
+            decoded = decoded if isinstance(decoded, tuple) else (decoded,)
+            if self.frames is None:
+                self.frames = decoded
+            else:
+                stale = changed + removed
+                self.frames = tuple(pd.concat([old[~old[key].isin(stale)], new], ignore_index=True)
+                                    for old, new, key in zip(self.frames, decoded, self.keys))
+        self.versions = versions
+        self.timestamp = feed.header.timestamp
+        return ChangeSet(inserted, changed, removed)
+
+
+def entity_version(entity):
+    """
+    Value that changes when a feed entity changes: the timestamp of a trip update or vehicle position,
+    the serialized entity if it has no timestamp (e.g. an alert)
+    """
+    if entity.HasField('trip_update') and entity.trip_update.timestamp:
+        return entity.trip_update.timestamp
+    if entity.HasField('vehicle') and entity.vehicle.timestamp:
+        return entity.vehicle.timestamp
+    return entity.SerializeToString()
+
+
+# Measurements of one processing stage, times in seconds and memory in bytes. Fields that do not
+# apply to a stage are None, peak_memory is only measured when memory tracing is enabled.
+StageMetrics = namedtuple('StageMetrics', ['stage', 'started', 'wall_time', 'cpu_time', 'rows_in', 'rows_out',
+                                           'bytes_read', 'bytes_written', 'peak_memory', 'error'])
+
+
+class StageRecorder:
+    """
+    Records wall time, CPU time, rows in/out, bytes and peak memory of processing stages. Every
+    finished stage is kept (up to history stages) and passed to the hooks, e.g. to export or print it.
+    Stages may be nested and run in several threads, the peak memory of a stage includes that of its
+    nested stages. CPU time is that of the whole process.
+    """
+
+    def __init__(self, trace_memory=False, history=10000, hooks=None):
+        """
+        :param bool trace_memory: Measure the peak memory of every stage with tracemalloc (slows down
+                                  allocation heavy stages)
+        :param int history: Number of finished stages to keep
+        :param list hooks: Callables receiving the StageMetrics of every finished stage
+        """
+        self.metrics = deque(maxlen=history)
+        self.hooks = list(hooks or [])
+        self.trace_memory = trace_memory
+        self.local = threading.local()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, rows_in=None, bytes_read=None):
+        """
+        Measure a stage. The yielded dictionary can be used to fill in rows_in, rows_out, bytes_read
+        and bytes_written while the stage runs.
+
+        :param str name: Name of the stage as kind:subject, e.g. zip_read:stops.txt
+        :param int rows_in: Number of input rows
+        :param int bytes_read: Number of bytes read
+        """
+        record = {'rows_in': rows_in, 'rows_out': None, 'bytes_read': bytes_read, 'bytes_written': None}
+        peaks = self.local.__dict__.setdefault('peaks', [])
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if peaks:
+                peaks[-1][1] = max(peaks[-1][1], peak)
+            tracemalloc.reset_peak()
+            peaks.append([current, current])
+        started = datetime.now()
+        wall, cpu = time.perf_counter(), time.process_time()
+        error = None
+        try:
+            yield record
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            peak_memory = None
+            if tracing:
+                base, peak = peaks.pop()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if peaks:
+                    peaks[-1][1] = max(peaks[-1][1], peak)
+                peak_memory = peak - base
+            self.record(StageMetrics(name, started, wall, cpu, record['rows_in'], record['rows_out'],
+                                     record['bytes_read'], record['bytes_written'], peak_memory, error))
+
+    def record(self, metrics):
+        """
+        Keep the metrics of a finished stage and pass them to the hooks
+        """
+        self.metrics.append(metrics)
+        for hook in self.hooks:
+            hook(metrics)
+
+    def to_frame(self):
+        """
+        The kept metrics as a DataFrame, one row per stage
+        """
+        return pd.DataFrame(list(self.metrics), columns=StageMetrics._fields)
+
+    def export(self, filename):
+        """
+        Append the kept metrics to a JSON lines file (one JSON object per stage) and forget them
+
+        :param str filename: The file to append to
+        """
+        with open(filename, 'a') as f:
+            while self.metrics:
+                metrics = self.metrics.popleft()._asdict()
+                metrics['started'] = metrics['started'].isoformat()
+                f.write(json.dumps(metrics) + '\n')
+
+
+def print_stage(metrics):
+    """
+    Hook printing one line per finished stage
+    """
+    line = '{:<36s} : {:>8.3f} s'.format(metrics.stage, metrics.wall_time)
+    if metrics.rows_out is not None:
+        line += ' {:>9} rows'.format(metrics.rows_out)
+    if metrics.error:
+        line += ' ' + metrics.error
+    print(line)
+
+
+# Columns holding IDs and the ID dictionary they are encoded with
+ID_COLUMNS = {'stop_id': 'stop_id', 'parent_station': 'stop_id', 'route_id': 'route_id',
+              'trip_id': 'trip_id', 'service_id': 'service_id'}
+
+# Table defining the ID dictionary of every kind of ID
+ID_TABLES = {'stop_id': 'stop_table', 'route_id': 'routes', 'trip_id': 'feed_trips', 'service_id': 'services'}
+
+# Tables and indexes of the static feed, loaded on first access
+STATIC_TABLES = ['stop_table', 'stops', 'stop_index', 'stop_locations', 'platform_locations', 'routes', 'services',
+                 'feed_trips', 'feed_stoptimes', 'calendar', 'trips', 'stoptimes', 'timeline', 'timeline_times',
+                 'stop_bounds', 'trip_stop_index', 'shape_geometry']
+
+# Tables and indexes of the current service day, see select_day
+DAY_TABLES = ['calendar', 'trips', 'stoptimes', 'timeline', 'timeline_times', 'stop_bounds', 'trip_stop_index']
+
+
+def lazy_table(name, loader):
+    """
+    Property for a table (or index) of the static feed that is loaded by the GTFS method loader on
+    first access. A loader gets the tables it depends on through their properties, which loads
+    those first. The property is None as long as no static feed is loaded, see update_static.
+
+    :param str name: Name of the table
+    :param str loader: Name of the method loading the table
+    """
+    def get(self):
+        with self.loading:
+            if name not in self.tables and self.zipfn is not None:
+                getattr(self, loader)()
+            return self.tables.get(name)
+
+    def set(self, value):
+        self.tables[name] = value
+
+    return property(get, set, doc='{} (loaded by {} on first access)'.format(name, loader))
 
 
 class GTFS:
-    stops = None
-    routes = None
-    trips = None
-    calendar = None
-    stoptimes = None
+    static_url = 'http://gtfs.ovapi.nl/nl/gtfs-nl.zip'
+    realtime_url = 'https://gtfs.ovapi.nl/nl/'
+    stop_table = lazy_table('stop_table', 'load_stops')
+    stops = lazy_table('stops', 'load_stop_geometries')
+    stop_index = lazy_table('stop_index', 'build_stop_index')
+    stop_locations = lazy_table('stop_locations', 'build_stop_locations')
+    platform_locations = lazy_table('platform_locations', 'build_stop_locations')
+    routes = lazy_table('routes', 'load_routes')
+    services = lazy_table('services', 'load_services')
+    feed_trips = lazy_table('feed_trips', 'load_feed_trips')
+    feed_stoptimes = lazy_table('feed_stoptimes', 'load_feed_stoptimes')
+    calendar = lazy_table('calendar', 'load_calendar')
+    trips = lazy_table('trips', 'load_trips')
+    stoptimes = lazy_table('stoptimes', 'load_stoptimes')
+    timeline = lazy_table('timeline', 'build_departure_timeline')
+    timeline_times = lazy_table('timeline_times', 'build_departure_timeline')
+    stop_bounds = lazy_table('stop_bounds', 'build_departure_timeline')
+    trip_stop_index = lazy_table('trip_stop_index', 'build_trip_stop_index')
+    shape_geometry = lazy_table('shape_geometry', 'load_shape_geometry')
     trip_updates = None
     train_updates = None
     vehicle_positions = None
     alerts = None
     alerts_to_routes = None
     alerts_to_stops = None
+    stop_alerts = None
+    vehicle_locations = None
+    route_alerts = None
+    predicted_delays = None
     date = None
+    zipfn = None
+
+    def __init__(self, verbose=True, trace_memory=False):
+        """
+        :param bool verbose: Print the metrics of every processing stage
+        :param bool trace_memory: Measure the peak memory of every stage, see StageRecorder
+        """
+        self.instrumentation = StageRecorder(trace_memory, hooks=[print_stage] if verbose else None)
+        self.stage = self.instrumentation.stage
+        self.loading = threading.RLock()
+        self.tables = {}
+        self.ids = {}
+        self.keys = {}
+        self.validators = {}
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=len(REALTIME_FEEDS)))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=len(REALTIME_FEEDS)))
+        self.changes = {}
+        self.reset_realtime()
+
+    def reset_realtime(self):
+        """
+        Start with an empty realtime state, the next update_realtime decodes the feeds completely
+        """
+        def encoded(decode):
+            def decode_and_encode(entities, timestamp):
+                decoded = decode(entities, timestamp)
+                if isinstance(decoded, tuple):
+                    return tuple(self.encode_ids(df) for df in decoded)
+                return self.encode_ids(decoded)
+            return decode_and_encode
+
+        self.realtime = {'tripUpdates': RealtimeState(encoded(self.decode_trip_updates), ['id']),
+                         'trainUpdates': RealtimeState(encoded(self.decode_train_updates), ['id']),
+                         'vehiclePositions': RealtimeState(encoded(self.decode_vehicle_positions), ['id']),
+                         'alerts': RealtimeState(encoded(self.decode_alerts), ['id', 'alert_id', 'alert_id'])}
 
     def file_age(self, filename):
         """
@@ -37,116 +874,749 @@ class GTFS:
         else:
             return 99999
 
-    def download_url(self, url, filename, max_days=0, max_minutes=0):
+    def download_url(self, url, filename, max_days=0, max_minutes=0, timeout=60):
         """
         Download the given URL and save under filename.
         If the filename contains a directory, it is assoumed the directory exists.
+        When the file exists but is too old, a conditional request (ETag / If-Modified-Since) is done,
+        so an unchanged file is not downloaded again. The file is only replaced when the download completes.
 
         :param str url: The URL to download
         :param str filename: The filename to save the file under
         :param int max_days: Maximum age in days the already downloaded file may be
         :param int max_minutes: Maximum age in minutes the already downloaded file may be
+        :param int timeout: Timeout in seconds for connecting and for every read
+        :return: FetchResult with status 'cached', 'not_modified', 'downloaded' or 'error'
         """
-        max_age = max_days * 1440 + max_minutes
+        with self.stage('download:' + os.path.basename(filename)) as stage:
+            stage['bytes_read'] = 0
+            return self._download_url(url, filename, max_days * 1440 + max_minutes, timeout, stage)
+
+    def _download_url(self, url, filename, max_age, timeout, stage):
         if os.path.exists(filename) and self.file_age(filename) < max_age:
             # Cached version exists and is still valid
-            # print('Using existing file {}'.format(filename))
-            return
+            return FetchResult(url, filename, 'cached', None)
+        headers = {}
+        if os.path.exists(filename):
+            validators = self.validators.get(url, {})
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            headers['If-Modified-Since'] = validators.get('Last-Modified',
+                                                          formatdate(os.path.getmtime(filename), usegmt=True))
         try:
-            # print('Downloading new file from {}'.format(url))
-            with urllib.request.urlopen(url) as resp:
-                file_content = resp.read()
-            with open(filename, 'wb') as f:
-                f.write(file_content)
-        except Exception as e:
-            print(e)
+            with self.session.get(url, headers=headers, timeout=timeout, stream=True) as resp:
+                if resp.status_code == 304:
+                    os.utime(filename)
+                    return FetchResult(url, filename, 'not_modified', None)
+                resp.raise_for_status()
+                with open(filename + '.part', 'wb') as f:
+                    for chunk in resp.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+                        stage['bytes_read'] += len(chunk)
+                os.replace(filename + '.part', filename)
+                self.validators[url] = {k: resp.headers[k] for k in ['ETag', 'Last-Modified'] if k in resp.headers}
+            return FetchResult(url, filename, 'downloaded', None)
+        except (requests.RequestException, OSError) as e:
+            return FetchResult(url, filename, 'error', str(e))
+
+    def fetch_realtime(self, max_age=15, timeout=30):
+        """
+        Download the realtime feeds concurrently, see download_url
+
+        :param int max_age: Maximum age of the downloaded files (in minutes)
+        :param int timeout: Timeout in seconds per request
+        :return: Dictionary with the FetchResult per feed
+        """
+        def fetch(feed):
+            return self.download_url(self.realtime_url + feed + '.pb', feed + '.pb',
+                                     max_minutes=max_age, timeout=timeout)
+
+        with ThreadPoolExecutor(max_workers=len(REALTIME_FEEDS)) as pool:
+            return dict(zip(REALTIME_FEEDS, pool.map(fetch, REALTIME_FEEDS)))
 
     def read_from_zip(self, zipfn, csvfile, cols=None, types=None):
+        with self.stage('zip_read:' + csvfile) as stage:
+            with zipfile.ZipFile(zipfn) as z:
+                stage['bytes_read'] = z.getinfo(csvfile).compress_size
+                with z.open(csvfile) as f:
+                    df = pd.read_csv(f, usecols=cols, dtype=types)
+            stage['rows_out'] = len(df)
+            return df
+
+    def read_stop_times(self, zipfn, cols, trip_ids=None, block_size=1 << 24):
+        """
+        Read stop_times.txt from a GTFS zip with the multithreaded pyarrow CSV reader: the zip member is
+        decompressed by the reader's read-ahead while blocks are parsed in parallel. IDs and times are
+        read dictionary encoded with one dictionary per column, so every distinct ID is looked up and
+        every distinct time is parsed only once. Rows of trips that are not in trip_ids are dropped
+        before anything is converted to pandas, the remaining rows are written directly into typed
+        columns: IDs as codes of the shared ID dictionaries and times as float32 seconds since the
+        start of the service day.
+
+        :param str zipfn: The GTFS zip file
+        :param list cols: Columns to read, missing optional columns are all null
+        :param trip_ids: Only keep the stop times of these trips, all stop times if None
+        :param int block_size: Number of bytes of CSV per parsed block
+        :return: DataFrame with categorical ID columns and float32 time columns
+        """
+        dictionary = pa.dictionary(pa.int32(), pa.string())
+        types = {c: dictionary for c in cols if c in ID_COLUMNS or c.endswith('_time') or c == 'stop_headsign'}
+        types.update({'stop_sequence': pa.int64(), 'shape_dist_traveled': pa.float64()})
+        id_types = {c: self.id_dictionary(ID_COLUMNS[c]) for c in cols if c in ID_COLUMNS}
+
+        with self.stage('zip_read:stop_times.txt') as stage:
+            with zipfile.ZipFile(zipfn) as z:
+                stage['bytes_read'] = z.getinfo('stop_times.txt').compress_size
+                with z.open('stop_times.txt') as f:
+                    table = csv.read_csv(f, read_options=csv.ReadOptions(use_threads=True, block_size=block_size),
+                                         convert_options=csv.ConvertOptions(include_columns=cols,
+                                                                            include_missing_columns=True,
+                                                                            column_types=types))
+            table = table.unify_dictionaries().combine_chunks()
+            stage['rows_in'] = table.num_rows
+
+            # ID codes per dictionary entry, missing values and unknown IDs get code -1
+            codes = {}
+            for c in id_types:
+                column = table.column(c).combine_chunks()
+                codes[c] = dictionary_take(column, pd.Categorical(column.dictionary.to_numpy(zero_copy_only=False),
+                                                                  dtype=id_types[c]).codes, -1)
+            if trip_ids is not None:
+                keep = np.zeros(len(id_types['trip_id'].categories) + 1, dtype=bool)
+                trip_codes = pd.Categorical(trip_ids, dtype=id_types['trip_id']).codes
+                keep[trip_codes[trip_codes >= 0]] = True
+                mask = keep[codes['trip_id']]
+                table = table.filter(mask)
+                codes = {c: v[mask] for c, v in codes.items()}
+
+            df = {}
+            for c in cols:
+                column = table.column(c).combine_chunks()
+                if c in id_types:
+                    df[c] = pd.Categorical.from_codes(codes[c], dtype=id_types[c])
+                elif c.endswith('_time'):
+                    seconds = gtfs_time_to_seconds(column.dictionary).astype(np.float32)
+                    df[c] = dictionary_take(column, seconds, np.nan)
+                elif pa.types.is_dictionary(column.type):
+                    df[c] = column.dictionary_decode().to_numpy(zero_copy_only=False)
+                else:
+                    df[c] = column.to_numpy(zero_copy_only=False)
+            df = pd.DataFrame(df)
+            stage['rows_out'] = len(df)
+            return df
+
+    def add_id_dictionary(self, kind, values):
+        """
+        Register the ID dictionary for one kind of ID (stop_id, route_id, trip_id or service_id).
+        All frames store IDs of this kind as categoricals sharing this dictionary, so merges compare
+        integer codes instead of hashing strings.
+
+        :param str kind: The kind of ID
+        :param values: All IDs of this kind in the static feed
+        """
+        values = pd.Series(values).dropna().unique()
+        self.ids[kind] = pd.CategoricalDtype(np.unique(np.asarray(values, dtype=str)))
+
+    def encode_ids(self, df):
+        """
+        Convert the ID columns of a frame to the shared ID dictionaries. IDs that are not in the
+        static feed (e.g. realtime trips without a planned trip) are appended to the dictionary, so
+        the codes of the static IDs stay valid and no ID is lost. Frames encoded before the dictionary
+        grew are relabelled, see extend_id_dictionary.
+
+        :param df: Frame with ID columns
+        :return: The frame with categorical ID columns
+        """
+        for column, kind in ID_COLUMNS.items():
+            if column in df.columns and self.id_dictionary(kind) is not None:
+                values = df[column]
+                if not isinstance(values.dtype, pd.CategoricalDtype):
+                    values = values.astype(str).where(values.notnull())
+                with self.loading:
+                    codes = pd.Categorical(values, dtype=self.ids[kind]).codes.astype(np.int64)
+                    unknown = (codes < 0) & values.notnull().to_numpy()
+                    if unknown.any():
+                        new, inverse = np.unique(np.asarray(values[unknown], dtype=str), return_inverse=True)
+                        codes[unknown] = len(self.ids[kind].categories) + inverse
+                        self.extend_id_dictionary(kind, new)
+                    df[column] = pd.Categorical.from_codes(codes, dtype=self.ids[kind], validate=False)
+        return df
+
+    def extend_id_dictionary(self, kind, values):
+        """
+        Append IDs that are not in the static feed to the ID dictionary of a kind. The codes of the IDs
+        already in the dictionary do not change, so the static tables and the realtime frames are
+        relabelled to the extended dictionary without recoding and keep sharing one dictionary.
+
+        :param str kind: The kind of ID
+        :param values: The new IDs
+        """
+        previous = self.ids[kind]
+        dtype = pd.CategoricalDtype(previous.categories.append(pd.Index(values)))
+        columns = [column for column, k in ID_COLUMNS.items() if k == kind]
+
+        def relabel(df):
+            if not isinstance(df, pd.DataFrame):
+                return df
+            relabelled = {c: pd.Categorical.from_codes(df[c].cat.codes, dtype=dtype, validate=False)
+                          for c in columns if c in df.columns and df[c].dtype == previous}
+            return df.assign(**relabelled) if relabelled else df
+
+        self.ids[kind] = dtype
+        for name, table in self.tables.items():
+            self.tables[name] = relabel(table)
+        for feed, state in self.realtime.items():
+            if state.frames is not None:
+                state.frames = tuple(relabel(df) for df in state.frames)
+            for attribute in REALTIME_FRAMES[feed]:
+                setattr(self, attribute, relabel(getattr(self, attribute)))
+
+    def feed_fingerprint(self, zipfn, members=None):
+        """
+        Fingerprint of a GTFS zip, based on name, CRC and size of its members as stored in the
+        zip directory. Nothing is decompressed, so this is cheap even for gtfs-nl.zip.
+
+        :param str zipfn: The GTFS zip file
+        :param list members: Only fingerprint these members, all members if None
+        :return: Hex digest
+        """
         with zipfile.ZipFile(zipfn) as z:
-            with z.open(csvfile) as f:
-                return pd.read_csv(f, usecols=cols, dtype=types)
+            infos = sorted(z.infolist(), key=lambda i: i.filename)
+        h = hashlib.sha1()
+        for info in infos:
+            if members is None or info.filename in members:
+                h.update('{}:{:08x}:{};'.format(info.filename, info.CRC, info.file_size).encode())
+        return h.hexdigest()
+
+    def stage_key(self, *parts):
+        """
+        Key describing what a derived table is built from: feed fingerprints, keys of the stages
+        it depends on, the service day and load parameters.
+        """
+        return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def cache_key(self, filename):
+        """
+        Return the stage key a cache file was built from, None if there is no (valid) cache file
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            with pa.memory_map(filename) as source:
+                metadata = pa.ipc.open_file(source).schema.metadata or {}
+        except (pa.ArrowInvalid, OSError):
+            return None
+        key = metadata.get(b'gtfs_stage_key')
+        return key.decode() if key else None
+
+    def write_cache(self, df, filename, key=None):
+        """
+        Store a frame as an uncompressed Feather (Arrow IPC) file, so it can be memory-mapped when read.
+        A geometry column is not stored, stops rebuild it from stop_lat/stop_lon.
+
+        :param df: The (Geo)DataFrame to store
+        :param str filename: The cache file
+        :param str key: Stage key recorded in the file, see stage_key
+        """
+        with self.stage('cache_write:' + filename, rows_in=len(df)) as stage:
+            df = pd.DataFrame(df.drop(columns='geometry', errors='ignore')).reset_index(drop=True)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if key:
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                       b'gtfs_stage_key': key.encode()})
+            feather.write_feather(table, filename, compression='uncompressed')
+            stage['bytes_written'] = os.path.getsize(filename)
+
+    def read_cache(self, filename, columns=None):
+        """
+        Read a Feather cache file written by write_cache. The file is memory-mapped, so processes
+        reading the same cache share pages and only the requested columns are touched.
+
+        :param str filename: The cache file
+        :param list columns: Columns to read, all columns if None
+        :return: DataFrame
+        """
+        with self.stage('cache_read:' + filename) as stage:
+            table = feather.read_table(filename, columns=columns, memory_map=True)
+            stage.update(rows_out=table.num_rows, bytes_read=table.nbytes)
+            return table.to_pandas()
 
     def update_static(self, day=None):
+        """
+        Prepare loading the static GTFS tables from the (downloaded) feed. Tables are loaded on first
+        access, together with the tables they depend on (see lazy_table), so a caller only pays for the
+        tables it uses. Trips and stop times are read once for the whole validity period of the feed,
+        together with an index of the days every service runs, and the given day is selected from that
+        (see select_day and get_service_days). The shapes are exposed as shape_geometry, memory-mapped
+        from a store built once per feed version (see shape_store). Every table is cached and only rebuilt
+        when the feed members, tables or parameters it was built from have changed.
+        Every stage (download, read, convert, merge, cache write, index) is measured, see instrumentation.
+
+        :param str day: Service day as YYYY-MM-DD, defaults to today
+        """
         if not day:
             day = datetime.now().strftime('%Y-%m-%d')
 
-        self.download_url('http://gtfs.ovapi.nl/nl/gtfs-nl.zip', 'gtfs-nl.zip', max_days=7)
+        with self.stage('update:static'):
+            zipfn = 'gtfs-nl.zip'
+            result = self.download_url(self.static_url, zipfn, max_days=7)
+            if result.status == 'error':
+                print('Error downloading {} : {}'.format(result.url, result.error))
+            with self.loading:
+                self.zipfn = zipfn
+                self.tables = {}
+                self.ids = {}
+                self.keys = {}
+                self.select_day(day)
+        # Realtime rows are encoded with the ID dictionaries of this load
+        self.reset_realtime()
 
-        fn = 'stops.pcl'
-        if self.file_age(fn) < 24 * 60:
-            self.stops = pd.read_pickle(fn)
-        else:
+    def preload(self, *tables):
+        """
+        Load tables now instead of on first access, e.g. before serving queries
+
+        :param tables: Names of the tables, all of STATIC_TABLES if none are given
+        """
+        for name in tables or STATIC_TABLES:
+            getattr(self, name)
+
+    def id_dictionary(self, kind):
+        """
+        The ID dictionary of a kind of ID, loading the table that defines it if necessary.
+        None if no static feed is loaded.
+        """
+        if kind not in self.ids and self.zipfn is not None:
+            getattr(self, ID_TABLES[kind])
+        return self.ids.get(kind)
+
+    def load_stops(self):
+        """
+        Load stop_table: all stops, stations and platforms
+        """
+        with self.stage('load:stops'):
+            fn = 'stops.feather'
             cols = ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon',
                     'location_type', 'parent_station', 'platform_code', 'zone_id']
             types = {'stop_lat': float, 'stop_lon': float, 'location_type': int, 'stop_id': str}
-            self.stops = self.read_from_zip('gtfs-nl.zip', 'stops.txt', cols, types)
-            self.stops = gpd.GeoDataFrame(self.stops,
-                                          geometry=gpd.points_from_xy(self.stops.stop_lon, self.stops.stop_lat))
-            self.stops.to_pickle(fn)
-        print('\nStops             : {}'.format(len(self.stops)))
-
-        fn = 'routes.pcl'
-        if self.file_age(fn) < 24 * 60:
-            self.routes = pd.read_pickle(fn)
-        else:
+            self.keys['stops'] = self.stage_key(self.feed_fingerprint(self.zipfn, ['stops.txt']), cols, types)
+            cached = self.cache_key(fn) == self.keys['stops']
+            stops = self.read_cache(fn) if cached else self.read_from_zip(self.zipfn, 'stops.txt', cols, types)
+            with self.stage('convert:stops', rows_in=len(stops)) as stage:
+                self.add_id_dictionary('stop_id', stops.stop_id)
+                stops = self.encode_ids(stops)
+                stage['rows_out'] = len(stops)
+            if not cached:
+                self.write_cache(stops, fn, self.keys['stops'])
+            self.stop_table = stops
+
+    def load_stop_geometries(self):
+        """
+        Load stops: stop_table as a GeoDataFrame with the stop locations as geometry
+        """
+        import geopandas as gpd
+        stops = self.stop_table
+        with self.stage('convert:stop_geometries', rows_in=len(stops)):
+            self.stops = gpd.GeoDataFrame(stops, geometry=gpd.points_from_xy(stops.stop_lon, stops.stop_lat))
+
+    def build_stop_index(self):
+        """
+        Build stop_index, the name index on stop_table
+        """
+        stops = self.stop_table
+        with self.stage('index:stop_names', rows_in=len(stops)):
+            self.stop_index = StopNameIndex(stops.stop_name)
+
+    def build_stop_locations(self):
+        """
+        Build stop_locations and platform_locations, the spatial indexes on all stops and on the
+        platforms / stop points (location_type 0) of stop_table
+        """
+        stops = self.stop_table
+        with self.stage('index:stop_locations', rows_in=len(stops)):
+            self.stop_locations = SpatialIndex(stops.stop_lon, stops.stop_lat)
+            platforms = np.flatnonzero(stops.location_type.to_numpy() == 0)
+            self.platform_locations = SpatialIndex(stops.stop_lon.iloc[platforms],
+                                                   stops.stop_lat.iloc[platforms], platforms)
+
+    def load_routes(self):
+        """
+        Load routes
+        """
+        with self.stage('load:routes'):
+            fn = 'routes.feather'
             cols = ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type']
             types = {'route_id': str}
-            self.routes = self.read_from_zip('gtfs-nl.zip', 'routes.txt', cols, types)
-            self.routes.to_pickle(fn)
-        print('Routes            : {}'.format(len(self.routes)))
+            self.keys['routes'] = self.stage_key(self.feed_fingerprint(self.zipfn, ['routes.txt']), cols, types)
+            cached = self.cache_key(fn) == self.keys['routes']
+            routes = self.read_cache(fn) if cached else self.read_from_zip(self.zipfn, 'routes.txt', cols, types)
+            with self.stage('convert:routes', rows_in=len(routes)) as stage:
+                self.add_id_dictionary('route_id', routes.route_id)
+                routes = self.encode_ids(routes)
+                stage['rows_out'] = len(routes)
+            if not cached:
+                self.write_cache(routes, fn, self.keys['routes'])
+            self.routes = routes
 
-        fn = 'calendar.pcl'
-        if self.file_age(fn) < 24 * 60:
-            self.calendar = pd.read_pickle(fn)
-        else:
-            types = {'date': str}
-            self.calendar = self.read_from_zip('gtfs-nl.zip', 'calendar_dates.txt', types=types)
-            self.calendar['date'] = self.calendar.date.str[:4] + '-' + \
-                                    self.calendar.date.str[4:6] + '-' + self.calendar.date.str[6:8]
-            self.calendar = self.calendar[self.calendar.date == day]
-            self.calendar.to_pickle(fn)
-        self.date = datetime.strptime(self.calendar.iloc[0, 1], "%Y-%m-%d")
-        print('Services          : {}'.format(len(self.calendar)))
-
-        fn = 'trips.pcl'
-        if self.file_age(fn) < 24 * 60:
-            self.trips = pd.read_pickle(fn)
-        else:
+    def load_services(self):
+        """
+        Load services: the days every service runs
+        """
+        with self.stage('load:services'):
+            fn = 'services.feather'
+            types = {'service_id': str, 'date': str}
+            self.keys['services'] = self.stage_key(self.feed_fingerprint(self.zipfn, ['calendar_dates.txt']), types)
+            cached = self.cache_key(fn) == self.keys['services']
+            if cached:
+                services = self.read_cache(fn)
+            else:
+                services = self.read_from_zip(self.zipfn, 'calendar_dates.txt', types=types)
+            with self.stage('convert:services', rows_in=len(services)) as stage:
+                if not cached:
+                    if 'exception_type' in services.columns:
+                        services = services[services.exception_type == 1]
+                    services = pd.DataFrame({'service_id': services.service_id.values,
+                                             'date': pd.to_datetime(services.date, format='%Y%m%d').values})
+                    services = services.sort_values(['service_id', 'date'], ignore_index=True)
+                self.add_id_dictionary('service_id', services.service_id)
+                services = self.encode_ids(services)
+                stage['rows_out'] = len(services)
+            if not cached:
+                self.write_cache(services, fn, self.keys['services'])
+            self.services = services
+
+    def load_feed_trips(self):
+        """
+        Load feed_trips: the trips of the whole feed with their route, depends on routes and services
+        """
+        routes = self.routes
+        self.id_dictionary('service_id')
+        with self.stage('load:feed_trips'):
+            fn = 'feed_trips.feather'
             cols = ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'trip_short_name',
                     'trip_long_name', 'direction_id', 'shape_id']
-            types = {'trip_short_name': 'Int64', 'shape_id': 'Int64', 'trip_id': str, 'route_id': str}
-            self.trips = self.read_from_zip('gtfs-nl.zip', 'trips.txt', cols, types)
-            self.trips = self.trips.merge(self.routes)
-            self.trips = self.trips.merge(self.calendar[['service_id', 'date']], on='service_id')
-            self.trips.to_pickle(fn)
-        print('Trips             : {}'.format(len(self.trips)))
-
-        fn = 'stoptimes.pcl'
-        if self.file_age(fn) < 24 * 60:
-            self.stoptimes = pd.read_pickle(fn)
-        else:
-            tripids = self.trips.trip_id.values
+            types = {'trip_short_name': 'Int64', 'shape_id': 'Int64', 'trip_id': str, 'route_id': str,
+                     'service_id': str}
+            self.keys['feed_trips'] = self.stage_key(self.feed_fingerprint(self.zipfn, ['trips.txt']), cols, types,
+                                                     self.keys['routes'], self.keys['services'])
+            cached = self.cache_key(fn) == self.keys['feed_trips']
+            trips = self.read_cache(fn) if cached else self.read_from_zip(self.zipfn, 'trips.txt', cols, types)
+            with self.stage('convert:trips', rows_in=len(trips)) as stage:
+                self.add_id_dictionary('trip_id', trips.trip_id)
+                trips = self.encode_ids(trips)
+                stage['rows_out'] = len(trips)
+            if not cached:
+                with self.stage('merge:trips_routes', rows_in=len(trips)) as stage:
+                    trips = trips.merge(routes)
+                    stage['rows_out'] = len(trips)
+                self.write_cache(trips, fn, self.keys['feed_trips'])
+            self.feed_trips = trips
+
+    def load_feed_stoptimes(self):
+        """
+        Load feed_stoptimes: the stop times of the whole feed, depends on feed_trips and stop_table
+        """
+        self.id_dictionary('trip_id')
+        self.id_dictionary('stop_id')
+        with self.stage('load:feed_stoptimes'):
+            fn = 'feed_stoptimes.feather'
             cols = ['trip_id', 'stop_sequence', 'stop_id', 'stop_headsign', 'arrival_time',
                     'departure_time', 'shape_dist_traveled']
-            types = {'trip_id': str, 'stop_id': str}
-            with zipfile.ZipFile('gtfs-nl.zip') as z:
-                with z.open('stop_times.txt') as f:
-                    iter_csv = pd.read_csv(f, usecols=cols, dtype=types, iterator=True, chunksize=10000)
-                    self.stoptimes = pd.concat([chunk[chunk['trip_id'].isin(tripids)] for chunk in iter_csv])
-                self.stoptimes.arrival_time = \
-                    self.stoptimes.apply(lambda x: gtfs.businessday_to_datetime(time=x['arrival_time']), axis=1)
-                self.stoptimes.departure_time = \
-                    self.stoptimes.apply(lambda x: gtfs.businessday_to_datetime(time=x['departure_time']), axis=1)
-            self.stoptimes.to_pickle(fn)
-        print('Halteringen       : {}'.format(len(self.stoptimes)))
+            self.keys['feed_stoptimes'] = self.stage_key(self.feed_fingerprint(self.zipfn, ['stop_times.txt']),
+                                                         cols, 'pyarrow', self.keys['feed_trips'], self.keys['stops'])
+            cached = self.cache_key(fn) == self.keys['feed_stoptimes']
+            if cached:
+                stoptimes = self.encode_ids(self.read_cache(fn))
+            else:
+                # Times are stored as seconds since the start of the service day, the day is added per view.
+                # Stop times of trips that are not in trips.txt can not be used and are skipped.
+                stoptimes = self.read_stop_times(self.zipfn, cols, trip_ids=self.feed_trips.trip_id)
+            if not cached:
+                self.write_cache(stoptimes, fn, self.keys['feed_stoptimes'])
+            self.feed_stoptimes = stoptimes
+
+    def load_shape_geometry(self):
+        """
+        Load shape_geometry: the points of all shapes, memory-mapped from the shape store (see shape_store)
+        """
+        with self.stage('load:shapes'):
+            self.shape_geometry = self.shape_store(self.zipfn)
+
+    def shape_store(self, zipfn, filename='shapes.bin'):
+        """
+        The shapes of a GTFS zip as a ShapeGeometry on a memory-mapped store file: a shape_id index
+        with the offset of every shape and contiguous float32 latitude, longitude and distance arrays.
+        The store is built once per version of shapes.txt and opened without reading it afterwards.
+
+        :param str zipfn: The GTFS zip file
+        :param str filename: The store file
+        :return: ShapeGeometry
+        """
+        key = self.stage_key(self.feed_fingerprint(zipfn, ['shapes.txt']), SHAPE_STORE_MAGIC, 'float32')
+        self.keys['shapes'] = key
+        header = ShapeGeometry.read_header(filename)
+        if header is None or header[0]['key'] != key:
+            cols = ['shape_id', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled']
+            types = {'shape_pt_sequence': pa.int64(), 'shape_pt_lat': pa.float32(), 'shape_pt_lon': pa.float32(),
+                     'shape_dist_traveled': pa.float32()}
+            with self.stage('zip_read:shapes.txt') as stage:
+                with zipfile.ZipFile(zipfn) as z:
+                    stage['bytes_read'] = z.getinfo('shapes.txt').compress_size
+                    with z.open('shapes.txt') as f:
+                        shapes = csv.read_csv(f, read_options=csv.ReadOptions(use_threads=True),
+                                              convert_options=csv.ConvertOptions(include_columns=cols,
+                                                                                 column_types=types)).to_pandas()
+                stage['rows_out'] = len(shapes)
+            with self.stage('cache_write:' + filename, rows_in=len(shapes)) as stage:
+                ShapeGeometry.from_frame(shapes, dtype=np.float32).save(filename, key)
+                stage['bytes_written'] = os.path.getsize(filename)
+        with self.stage('cache_read:' + filename) as stage:
+            geometry = ShapeGeometry.open(filename)
+            stage['rows_out'] = len(geometry.offsets) - 1
+        return geometry
+
+    def get_service_days(self, start, end=None):
+        """
+        Slice calendar, trips and stoptimes for a range of service days from the feed-wide service
+        index loaded by update_static. The zip is not read again.
+        Trips and stoptimes get a row for every day a trip runs in the range, for a range of more
+        than one day stoptimes also has a date column with the service day.
+
+        :param str start: First service day as YYYY-MM-DD
+        :param str end: Last service day as YYYY-MM-DD, defaults to start
+        :return: Tuple with calendar, trips and stoptimes frames
+        """
+        first = pd.Timestamp(start)
+        last = pd.Timestamp(end) if end else first
+        calendar = self.services[(self.services.date >= first) & (self.services.date <= last)]
+
+        trips = self.feed_trips.merge(calendar, on='service_id')
+        stoptimes = self.feed_stoptimes.merge(trips[['trip_id', 'date']], on='trip_id')
+        for c in ['arrival_time', 'departure_time']:
+            stoptimes[c] = stoptimes.date + pd.to_timedelta(stoptimes[c].astype(float), unit='s')
+        if first == last:
+            stoptimes = stoptimes.drop(columns='date')
+        else:
+            stoptimes['date'] = stoptimes.date.dt.strftime('%Y-%m-%d')
+
+        calendar = calendar.assign(date=calendar.date.dt.strftime('%Y-%m-%d'))
+        trips['date'] = trips.date.dt.strftime('%Y-%m-%d')
+        return calendar.reset_index(drop=True), trips, stoptimes
+
+    def select_day(self, day):
+        """
+        Make the given service day the current one. calendar, trips, stoptimes and the departure
+        timeline are sliced for it from the service index on first access.
+
+        :param str day: Service day as YYYY-MM-DD
+        """
+        with self.loading:
+            self.date = datetime.strptime(day, "%Y-%m-%d")
+            for name in DAY_TABLES:
+                self.tables.pop(name, None)
+            self.predicted_delays = None
+
+    def load_calendar(self):
+        """
+        Load calendar: the services running on the current service day
+        """
+        services = self.services
+        calendar = services[services.date == pd.Timestamp(self.date)]
+        self.calendar = calendar.assign(date=calendar.date.dt.strftime('%Y-%m-%d')).reset_index(drop=True)
+
+    def load_trips(self):
+        """
+        Load trips: the trips running on the current service day, depends on feed_trips (with routes)
+        and calendar
+        """
+        feed_trips, calendar = self.feed_trips, self.calendar
+        with self.stage('filter:trips', rows_in=len(feed_trips)) as stage:
+            self.trips = feed_trips.merge(calendar, on='service_id')
+            stage['rows_out'] = len(self.trips)
+
+    def load_stoptimes(self):
+        """
+        Load stoptimes: the stop times of the trips running on the current service day, depends on trips
+        """
+        feed_stoptimes, trips = self.feed_stoptimes, self.trips
+        with self.stage('filter:stop_times', rows_in=len(feed_stoptimes)) as stage:
+            stoptimes = feed_stoptimes.merge(trips[['trip_id']], on='trip_id')
+            day = pd.Timestamp(self.date)
+            for c in ['arrival_time', 'departure_time']:
+                stoptimes[c] = day + pd.to_timedelta(stoptimes[c].astype(float), unit='s')
+            self.stoptimes = stoptimes
+            stage['rows_out'] = len(stoptimes)
+
+    def build_trip_stop_index(self):
+        """
+        Build trip_stop_index, the (trip_id, stop_sequence) index on stoptimes
+        """
+        stoptimes = self.stoptimes
+        with self.stage('index:trip_stops', rows_in=len(stoptimes)):
+            self.trip_stop_index = TripStopIndex(stoptimes.trip_id, stoptimes.stop_sequence)
+
+    def predict_delays(self):
+        """
+        Predicted arrival and departure delays (in seconds) of all stop times of the current service day.
+        Delays of trip_updates (and, where a trip has no update for its current stop, the OVapi delay of
+        vehicle_positions) are matched with stoptimes through trip_stop_index, after which the last known
+        delay of every trip is carried forward to its following stops. Stops before the first known
+        delay of a trip keep a missing delay. The result is kept until the realtime feeds or the service
+        day change.
+
+        :return: DataFrame aligned with stoptimes with arrival_delay, departure_delay (float, NaN if
+                 unknown) and RT (the stop time has a trip update of its own)
+        """
+        if self.predicted_delays is not None:
+            return self.predicted_delays
+        stoptimes, index = self.stoptimes, self.trip_stop_index
+        with self.stage('predict:delays', rows_in=len(stoptimes)) as stage:
+            delays = {'arrival': np.full(len(stoptimes), np.nan), 'departure': np.full(len(stoptimes), np.nan)}
+            realtime = np.zeros(len(stoptimes), dtype=bool)
+            if self.vehicle_positions is not None:
+                vehicles = self.vehicle_positions
+                positions = index.lookup(vehicles.trip_id, vehicles.current_stop_seq)
+                delay = vehicles.delay.to_numpy(dtype=float, na_value=np.nan)
+                found = (positions >= 0) & ~np.isnan(delay)
+                for event in delays:
+                    delays[event][positions[found]] = delay[found]
+            if self.trip_updates is not None:
+                updates = self.trip_updates
+                positions = index.lookup(updates.trip_id, updates.stop_sequence)
+                found = positions >= 0
+                realtime[positions[found]] = True
+                for event in delays:
+                    delay = updates[event + '_delay'].to_numpy(dtype=float, na_value=np.nan)
+                    # Updates with a time but without a delay are compared with the planned time, only
+                    # the updates found in stoptimes are looked up (stoptimes is empty on a day without service)
+                    planned = stoptimes[event + '_time'].to_numpy()[positions[found]]
+                    actual = updates[event + '_time'].to_numpy()[found]
+                    delay[found] = np.where(np.isnan(delay[found]), (actual - planned) / np.timedelta64(1, 's'),
+                                            delay[found])
+                    known = found & ~np.isnan(delay)
+                    delays[event][positions[known]] = delay[known]
+            arrival, departure = index.propagate(delays['arrival'], delays['departure'])
+            self.predicted_delays = pd.DataFrame({'arrival_delay': arrival, 'departure_delay': departure,
+                                                  'RT': realtime}, index=stoptimes.index)
+            stage['rows_out'] = int((~np.isnan(departure)).sum())
+        return self.predicted_delays
+
+    def get_predicted_stoptimes(self):
+        """
+        Complete predicted timetable of the current service day: stoptimes with the planned times in
+        planned_arrival_time and planned_departure_time, and arrival_time and departure_time shifted by
+        the predicted delays (see predict_delays), missing delays are 0.
+        """
+        stoptimes, delays = self.stoptimes, self.predict_delays()
+        df = stoptimes.rename(columns={'arrival_time': 'planned_arrival_time',
+                                       'departure_time': 'planned_departure_time'})
+        for event in ['arrival', 'departure']:
+            delay = delays[event + '_delay'].fillna(0)
+            df[event + '_time'] = stoptimes[event + '_time'] + pd.to_timedelta(delay, unit='s')
+            df[event + '_delay'] = nullable_int(delays[event + '_delay'])
+        df['RT'] = delays.RT
+        return df
+
+    def build_departure_timeline(self):
+        """
+        Build the departure timeline of the current service day: all departures with their trip
+        attributes, sorted per stop on departure time. stop_bounds holds for every stop_id code the
+        range of its departures, so the departures of a stop are found without scanning stoptimes.
+        """
+        stoptimes, trips = self.stoptimes, self.trips
+        with self.stage('index:timeline', rows_in=len(stoptimes)) as stage:
+            timeline = stoptimes[['stop_id', 'trip_id', 'stop_sequence', 'departure_time']]
+            timeline = timeline[timeline.stop_id.notnull() & timeline.departure_time.notnull()]
+            timeline = timeline.merge(trips[['trip_id', 'route_short_name', 'trip_short_name',
+                                             'trip_headsign']], on='trip_id')
+            codes = timeline.stop_id.cat.codes.to_numpy()
+            order = np.lexsort((timeline.departure_time.to_numpy(), codes))
+            self.timeline = timeline.iloc[order].reset_index(drop=True)
+            self.timeline_times = self.timeline.departure_time.to_numpy()
+            self.stop_bounds = np.searchsorted(codes[order],
+                                               np.arange(len(self.id_dictionary('stop_id').categories) + 1))
+            stage['rows_out'] = len(self.timeline)
+
+    def get_timeline(self, stop_ids, after=None, n=None, lookback=timedelta(minutes=30)):
+        """
+        Departures at the given stops from the departure timeline, with realtime delays applied.
+        The planned departures are found by binary search per stop, realtime information is only
+        looked up for those rows. With n, the planned departures of a stop are read until the next
+        unread planned departure is later than the n-th actual departure found, so a delayed departure
+        does not push out a later planned departure that leaves earlier.
+
+        :param stop_ids: The stops to get the departures for
+        :param datetime after: Only departures (including delay) after this time, all departures if None
+        :param int n: Maximum number of departures, all departures if None
+        :param timedelta lookback: Also consider planned departures this long before after, to
+                                   include delayed departures
+        :return: Departures sorted on (actual) departure time
+        """
+        stop_bounds, timeline_times = self.stop_bounds, self.timeline_times
+        codes = pd.Categorical(stop_ids, dtype=self.id_dictionary('stop_id')).codes
+        codes = np.unique(codes[(codes >= 0) & (codes < len(stop_bounds) - 1)])
+        frames = []
+        if after is None:
+            rows = [np.arange(stop_bounds[c], stop_bounds[c + 1]) for c in codes]
+            frames.append(self.apply_delays(self.timeline.iloc[np.concatenate(rows) if rows else []]))
+        else:
+            for c in codes:
+                lo, hi = stop_bounds[c], stop_bounds[c + 1]
+                times = timeline_times[lo:hi]
+                start = np.searchsorted(times, np.datetime64(after - lookback).astype(times.dtype))
+                end = np.searchsorted(times, np.datetime64(after).astype(times.dtype))
+                count = wanted = max(n or 0, 1)
+                while True:
+                    stop = hi - lo if n is None else min(end + count, hi - lo)
+                    df = self.apply_delays(self.timeline.iloc[lo + start:lo + stop])
+                    df = df[df.departure_time > after]
+                    if stop == hi - lo:
+                        break
+                    actual = np.sort(df.departure_time.to_numpy())
+                    if len(actual) >= wanted and times[stop] > actual[wanted - 1].astype(times.dtype):
+                        break
+                    count *= 2
+                frames.append(df)
+        df = pd.concat(frames) if frames else self.apply_delays(self.timeline.iloc[[]])
+        df = df.sort_values('departure_time')
+        return df if n is None else df.head(n)
+
+    def apply_delays(self, df):
+        """
+        Shift the planned departure times of stop times of the current service day by their predicted
+        delays (see predict_delays), looked up on trip_id and stop_sequence. Adds departure_delay and RT
+        (a realtime prediction is available, from the stop itself or carried forward from an earlier stop).
+        """
+        if self.trip_updates is None and self.vehicle_positions is None:
+            return df.assign(departure_delay=0, RT=False)
+        positions = self.trip_stop_index.lookup(df.trip_id, df.stop_sequence)
+        delays = self.predict_delays().departure_delay.to_numpy()
+        delay = np.where(positions >= 0, delays[np.maximum(positions, 0)], np.nan)
+        return df.assign(departure_time=df.departure_time + pd.to_timedelta(np.nan_to_num(delay), unit='s'),
+                         departure_delay=nullable_int(np.nan_to_num(delay)), RT=~np.isnan(delay))
 
     def convert_times(self, df, columns):
         for c in columns:
-            df[c] = pd.to_datetime(df[c], unit='s', utc=True).map(lambda x: x.tz_convert('Europe/Amsterdam'))
-            df[c] = df[c].apply(lambda x: x.replace(tzinfo=None))
+            df[c] = epoch_to_datetime(df[c])
         return df
 
+    def businessday_times_to_datetime(self, times, date=None):
+        """
+        Vectorized variant of businessday_to_datetime for a whole column of GTFS times.
+        Invalid times result in NaT.
+
+        :param times: Series with "HH:MM:SS" strings
+        :param str date: Service day as YYYYMMDD, defaults to the loaded service day
+        :return: Series with datetime64 values
+        """
+        day = pd.Timestamp(datetime.strptime(date, '%Y%m%d') if date else self.date)
+        seconds = gtfs_time_to_seconds(times)
+        res = day + pd.to_timedelta(seconds, unit='s')
+        return pd.Series(res, index=times.index if isinstance(times, pd.Series) else None)
+
     def businessday_to_datetime(self, date=None, time=None):
+        """
+        Convert a single service day and GTFS time to a datetime. Use businessday_times_to_datetime for columns.
+        """
         try:
             res = datetime.strptime(date, '%Y%m%d') if date else self.date
             hr = int(time[:2])
@@ -158,332 +1628,391 @@ class GTFS:
         except:
             return None
 
-    def update_realtime(self, max_age=15):
+    def read_feed(self, filename):
         """
-        Update the realtime information from GTFS
-        :param max_age: Maxium age of cache file (in mnutes)
-        :return:
+        Read a GTFS-realtime feed file
+
+        :param str filename: The .pb file
+        :return: FeedMessage
         """
-        feed = gtfs_realtime_pb2.FeedMessage()
-        print()
-
-        self.download_url('https://gtfs.ovapi.nl/nl/tripUpdates.pb', 'tripUpdates.pb', max_minutes=max_age)
-        with open('tripUpdates.pb', 'rb') as file:
-            data = file.read()
-        feed.ParseFromString(data)
-        tripUpdates = protobuf_to_dict(feed)
-        print("Trip updates      : {}".format(len(tripUpdates['entity'])))
-
-        self.download_url('https://gtfs.ovapi.nl/nl/trainUpdates.pb', 'trainUpdates.pb', max_minutes=max_age)
-        with open('trainUpdates.pb', 'rb') as file:
-            data = file.read()
-        feed.ParseFromString(data)
-        trainUpdates = protobuf_to_dict(feed)
-        print("Train updates     : {}".format(len(trainUpdates['entity'])))
-
-        self.download_url('https://gtfs.ovapi.nl/nl/vehiclePositions.pb', 'vehiclePositions.pb',
-                          max_minutes=max_age)
-        with open('vehiclePositions.pb', 'rb') as file:
-            data = file.read()
-        feed.ParseFromString(data)
-        vehiclePositions = protobuf_to_dict(feed)
-        print("Vehicle positions : {}".format(len(vehiclePositions['entity'])))
-
-        self.download_url('https://gtfs.ovapi.nl/nl/alerts.pb', 'alerts.pb', max_minutes=max_age)
-        with open('alerts.pb', 'rb') as file:
-            data = file.read()
-        feed.ParseFromString(data)
-        alerts = protobuf_to_dict(feed)
-        print("Alerts            : {}".format(len(alerts['entity'])))
-
-        # Additional fields are stored under these keys, not the correct names
-        rtid_keys = ['___X', '1003']
-        stop_keys = ['___X', '1003']
-        delay_keys = ['___X', '1003']
-
-        ###
-        # Trip updates
-        ###
-        uids = []
-        rt_ids = []
-        trip_ids = []
-        start_times = []
-        route_ids = []
-        direction_ids = []
-        vehicles = []
-        stop_sequences = []
-        arrival_times = []
-        arrival_delays = []
-        departure_times = []
-        departure_delays = []
-        timestamps = []
-
-        timestamp = datetime.fromtimestamp(tripUpdates['header']['timestamp'])
-        for tu in tripUpdates['entity']:
-            uid = tu['id']
-            trip_update = tu['trip_update']
-            vehicle = trip_update['vehicle']['label'] if 'vehicle' in trip_update else None
-            trip = trip_update['trip']
-            trip_id = trip['trip_id']
-            start_time = trip['start_time'] if 'start_time' in trip else None
-            start_date = trip['start_date']
-            start_time = self.businessday_to_datetime(start_date, start_time)
-            route_id = trip['route_id']
-            direction_id = int(trip['direction_id']) if 'direction_id' in trip else None
-            rt_id = trip[rtid_keys[0]][rtid_keys[1]]['realtime_trip_id'] if rtid_keys[0] in trip else None
-            for stu in trip_update['stop_time_update'] if 'stop_time_update' in trip_update else []:
-                stop_sequence = stu['stop_sequence']
-                if 'arrival' in stu:
-                    arr = stu['arrival']
-                    arrival_time = arr['time'] if 'time' in arr else None
-                    arrival_time = datetime.fromtimestamp(arrival_time)
-                    arrival_delay = arr['delay'] if 'delay' in arr else None
-                else:
-                    arrival_time = None
-                    arrival_delay = None
-                if 'departure' in stu:
-                    dep = stu['departure']
-                    departure_time = dep['time'] if 'time' in dep else None
-                    departure_time = datetime.fromtimestamp(departure_time)
-                    departure_delay = dep['delay'] if 'delay' in dep else None
-                else:
-                    departure_time = None
-                    departure_delay = None
-                ###
-                uids.append(uid)
-                rt_ids.append(rt_id)
-                trip_ids.append(trip_id)
-                start_times.append(start_time)
-                route_ids.append(route_id)
-                direction_ids.append(direction_id)
-                vehicles.append(vehicle)
-                stop_sequences.append(stop_sequence)
-                arrival_times.append(arrival_time)
-                arrival_delays.append(arrival_delay)
-                departure_times.append(departure_time)
-                departure_delays.append(departure_delay)
-                timestamps.append(timestamp)
-                ###
-        df_trip_updates = pd.DataFrame({'id': uids, 'RT_id': rt_ids, 'trip_id': trip_ids, 'start_time': start_times,
-                                        'route_id': route_ids, 'direction_id': direction_ids, 'vehicle': vehicles,
-                                        'stop_sequence': stop_sequences, 'arrival_time': arrival_times,
-                                        'arrival_delay': arrival_delays,
-                                        'departure_time': departure_times, 'departure_delay': departure_delays,
-                                        'timestamp': timestamps})
-        self.trip_updates = df_trip_updates
-        print("\nTrip updates      : {}".format(len(self.trip_updates)))
-
-        ###
-        # Train updates
-        ###
-        trip_ids = []
-        rt_ids = []
-        start_times = []
-        route_ids = []
-        direction_ids = []
-        stop_ids = []
-        arrival_times = []
-        arrival_delays = []
-        departure_times = []
-        departure_delays = []
-        timestamps = []
-        station_ids = []
-        train_numbers = []
-        scheduled_tracks = []
-
-        timestamp = trainUpdates['header']['timestamp']
-        timestamp = datetime.fromtimestamp(timestamp)
-        for tu in trainUpdates['entity']:
-            trip_id = tu['id']
-            trip_update = tu['trip_update']
-            trip = trip_update['trip']
-            route_id = trip['route_id'] if 'route_id' in trip else None
-            direction_id = int(trip['direction_id'])
-            additional = trip[rtid_keys[0]][rtid_keys[1]] if rtid_keys[0] in trip else None
-            rt_id = additional['realtime_trip_id'] if 'realtime_trip_id' in additional else None
-            train_number = additional['trip_short_name'] if 'trip_short_name' in additional else None
-            start_time = trip['start_time']
-            start_date = trip['start_date']
-            start_time = self.businessday_to_datetime(start_date, start_time)
-            if 'stop_time_update' in trip_update:
-                for su in trip_update['stop_time_update']:
-                    if 'stop_id' in su:
-                        if 'arrival' in su:
-                            arr = su['arrival']
-                            arrival_time = arr['time'] if 'time' in arr else None
-                            arrival_time = datetime.fromtimestamp(arrival_time)
-                            arrival_delay = arr['delay'] if 'delay' in arr else None
-                        else:
-                            arrival_time = None
-                            arrival_delay = None
-
-                        if 'departure' in su:
-                            dep = su['departure']
-                            departure_time = dep['time'] if 'time' in dep else None
-                            departure_time = datetime.fromtimestamp(departure_time)
-                            departure_delay = dep['delay'] if 'delay' in dep else None
-                        else:
-                            departure_time = None
-                            departure_delay = None
-                        stop_id = su['stop_id']
-                        additional = su[stop_keys[0]][stop_keys[1]] if stop_keys[0] in su else None
-                        if additional:
-                            scheduled_track = additional['scheduled_track'] if 'scheduled_track' in additional else None
-                            station_id = additional['station_id'] if 'station_id' in additional else None
-                        else:
-                            scheduled_track = station_id = None
-                        ###
-                        trip_ids.append(trip_id)
-                        rt_ids.append(rt_id)
-                        start_times.append(start_time)
-                        route_ids.append(route_id)
-                        direction_ids.append(direction_id)
-                        stop_ids.append(stop_id)
-                        arrival_times.append(arrival_time)
-                        arrival_delays.append(arrival_delay)
-                        departure_times.append(departure_time)
-                        departure_delays.append(departure_delay)
-                        timestamps.append(timestamp)
-                        station_ids.append(station_id)
-                        train_numbers.append(train_number)
-                        scheduled_tracks.append(scheduled_track)
-                        ###
-        df_train_updates = pd.DataFrame({'trip_id': trip_ids, 'RT_id': rt_ids, 'start_time': start_times,
-                                         'route_id': route_ids, 'direction_id': direction_ids, 'stop_id': stop_ids,
-                                         'arrival_time': arrival_times, 'arrival_delay': arrival_delays,
-                                         'departure_time': departure_times, 'departure_delay': departure_delays,
-                                         'timestamp': timestamps, 'station_id': station_ids,
-                                         'train_number': train_numbers, 'scheduled_track': scheduled_tracks})
-        df_train_updates['stop_id'] = df_train_updates['stop_id'].astype(str)
-        df_train_updates['route_id'] = df_train_updates['route_id'].astype(str)
-        df_train_updates['trip_id'] = df_train_updates['trip_id'].astype(str)
-        self.train_updates = df_train_updates
-        print("Train updates     : {}".format(len(self.train_updates)))
-
-        ###
-        # Vehicle positions
-        ###
-        vids = []
-        rt_ids = []
-        trip_ids = []
-        start_times = []
-        route_ids = []
-        direction_ids = []
-        latitudes = []
-        longitudes = []
-        current_stop_seqs = []
-        timestamps = []
-        labels = []
-        delays = []
-        for vp in vehiclePositions['entity']:
-            vid = vp['id']
-            vehicle = vp['vehicle']
-            trip = vehicle['trip']
-            trip_id = trip['trip_id']
-            start_time = trip['start_time'] if 'start_time' in trip else None
-            start_date = trip['start_date']
-            start_time = self.businessday_to_datetime(start_date, start_time)
-            route_id = trip['route_id']
-            rt_id = trip[rtid_keys[0]][rtid_keys[1]]['realtime_trip_id'] if rtid_keys[0] in trip else None
-            direction_id = int(trip['direction_id']) if 'direction_id' in trip else None
-            latitude = vehicle['position']['latitude'] if 'position' in vehicle else None
-            longitude = vehicle['position']['longitude'] if 'position' in vehicle else None
-            current_stop_seq = vehicle['current_stop_sequence'] if 'current_stop_sequence' in vehicle else None
-            timestamp = vehicle['timestamp']
-            timestamp = datetime.fromtimestamp(timestamp)
-            label = vehicle['vehicle']['label'] if 'vehicle' in vehicle else None
-            delay = int(vehicle[delay_keys[0]][delay_keys[1]]['delay']) if delay_keys[0] in vehicle else None
-            ###
-            vids.append(vid)
-            rt_ids.append(rt_id)
-            trip_ids.append(trip_id)
-            start_times.append(start_time)
-            route_ids.append(route_id)
-            direction_ids.append(direction_id)
-            latitudes.append(latitude)
-            longitudes.append(longitude)
-            current_stop_seqs.append(current_stop_seq)
-            timestamps.append(timestamp)
-            labels.append(label)
-            delays.append(delay)
-            ###
-        df_vehicle_positions = pd.DataFrame(
-            {'id': vids, 'RT_id': rt_ids, 'trip_id': trip_ids, 'start_time': start_times,
-             'route_id': route_ids, 'direction_id': direction_ids, 'latitude': latitudes,
-             'longitude': longitudes, 'current_stop_seq': current_stop_seqs,
-             'timestamp': timestamps, 'label': labels, 'delay': delays})
-        df_vehicle_positions['current_stop_seq'] = df_vehicle_positions['current_stop_seq'].astype('Int64')
-        df_vehicle_positions = gpd.GeoDataFrame(df_vehicle_positions,
-                                                geometry=gpd.points_from_xy(df_vehicle_positions.longitude,
-                                                                            df_vehicle_positions.latitude))
-        self.vehicle_positions = df_vehicle_positions
-        print("Vehicle positions : {}".format(len(self.vehicle_positions)))
+        with self.stage('parse:' + os.path.basename(filename)) as stage:
+            feed = realtime_modules()[0].FeedMessage()
+            with open(filename, 'rb') as file:
+                data = file.read()
+            feed.ParseFromString(data)
+            stage.update(bytes_read=len(data), rows_out=len(feed.entity))
+            return feed
+
+    def read_feed_header(self, filename):
+        """
+        Read the header of a GTFS-realtime feed file without parsing the entities. The header is the
+        first field of a serialized FeedMessage, so only the start of the file is read.
 
+        :param str filename: The .pb file
+        :return: FeedHeader, None if the file does not start with a header
+        """
+        with open(filename, 'rb') as file:
+            data = file.read(4096)
+        if data[:1] != b'\x0a':
+            return None
+        length, shift, position = 0, 0, 1
+        while position < len(data):
+            byte = data[position]
+            position += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        if position + length > len(data):
+            return None
+        header = realtime_modules()[0].FeedHeader()
+        header.ParseFromString(data[position:position + length])
+        return header
+
+    def decode_trip_updates(self, entities, timestamp):
+        """
+        Decode entities of a tripUpdates feed, one row per stop time update. Trip attributes are collected
+        once per entity and repeated, times are converted in bulk. A cancelled trip without stop time
+        updates gets one row without stop.
+
+        :param entities: The feed entities to decode
+        :param int timestamp: The feed (header) timestamp
+        """
+        ovapi_trip = realtime_modules()[1].ovapi_tripdescriptor
+        trips = {'id': [], 'RT_id': [], 'trip_id': [], 'start_date': [], 'start_time': [], 'route_id': [],
+                 'direction_id': array('d'), 'vehicle': [], 'relationship': array('q')}
+        counts = array('q')
+        stops = {'stop_sequence': array('d'), 'arrival_time': array('d'), 'arrival_delay': array('d'),
+                 'departure_time': array('d'), 'departure_delay': array('d'), 'relationship': array('q')}
+        for entity in entities:
+            trip_update = entity.trip_update
+            trip = trip_update.trip
+            ovapi = trip.Extensions[ovapi_trip] if trip.HasExtension(ovapi_trip) else None
+            trips['id'].append(entity.id)
+            trips['RT_id'].append(field(ovapi, 'realtime_trip_id'))
+            trips['trip_id'].append(field(trip, 'trip_id'))
+            trips['start_date'].append(field(trip, 'start_date'))
+            trips['start_time'].append(field(trip, 'start_time'))
+            trips['route_id'].append(field(trip, 'route_id'))
+            trips['direction_id'].append(field(trip, 'direction_id', np.nan))
+            trips['vehicle'].append(field(trip_update.vehicle, 'label') if trip_update.HasField('vehicle') else None)
+            trips['relationship'].append(trip.schedule_relationship)
+            if trip.schedule_relationship == TRIP_CANCELED and not trip_update.stop_time_update:
+                counts.append(1)
+                for column in stops.values():
+                    column.append(np.nan if column.typecode == 'd' else 0)
+                continue
+            counts.append(len(trip_update.stop_time_update))
+            for stu in trip_update.stop_time_update:
+                stops['stop_sequence'].append(field(stu, 'stop_sequence', np.nan))
+                append_stop_time_event(stops, 'arrival', stu)
+                append_stop_time_event(stops, 'departure', stu)
+                stops['relationship'].append(stu.schedule_relationship)
+
+        start_times = service_datetime(trips.pop('start_date'), trips.pop('start_time'))
+        df = pd.DataFrame({'id': repeat(trips['id'], counts), 'RT_id': repeat(trips['RT_id'], counts),
+                           'trip_id': repeat(trips['trip_id'], counts), 'start_time': repeat(start_times, counts),
+                           'route_id': repeat(trips['route_id'], counts),
+                           'direction_id': nullable_int(repeat(trips['direction_id'], counts)),
+                           'vehicle': repeat(trips['vehicle'], counts),
+                           'stop_sequence': nullable_int(stops['stop_sequence']),
+                           'arrival_time': epoch_to_datetime(stops['arrival_time']),
+                           'arrival_delay': nullable_int(stops['arrival_delay']),
+                           'departure_time': epoch_to_datetime(stops['departure_time']),
+                           'departure_delay': nullable_int(stops['departure_delay']),
+                           'schedule_relationship': schedule_relationships(repeat(trips['relationship'], counts),
+                                                                           stops['relationship'])})
+        df['timestamp'] = epoch_to_datetime([timestamp])[0]
+        return df
+
+    def decode_train_updates(self, entities, timestamp):
+        """
+        Decode entities of a trainUpdates feed, one row per stop time update with a stop_id. The entity
+        id is the trip_id, it is also kept as is in id. The OVapi extensions (realtime trip id, train
+        number, scheduled track and station) are read by descriptor.
+        """
+        extensions = realtime_modules()[1]
+        ovapi_trip, ovapi_stop_time = extensions.ovapi_tripdescriptor, extensions.ovapi_stop_time_update
+        trips = {'id': [], 'RT_id': [], 'start_date': [], 'start_time': [], 'route_id': [],
+                 'direction_id': array('d'), 'train_number': [], 'relationship': array('q')}
+        counts = array('q')
+        stops = {'stop_id': [], 'arrival_time': array('d'), 'arrival_delay': array('d'),
+                 'departure_time': array('d'), 'departure_delay': array('d'), 'station_id': [], 'scheduled_track': [],
+                 'relationship': array('q')}
+        for entity in entities:
+            trip_update = entity.trip_update
+            trip = trip_update.trip
+            ovapi = trip.Extensions[ovapi_trip] if trip.HasExtension(ovapi_trip) else None
+            trips['id'].append(entity.id)
+            trips['RT_id'].append(field(ovapi, 'realtime_trip_id'))
+            trips['start_date'].append(field(trip, 'start_date'))
+            trips['start_time'].append(field(trip, 'start_time'))
+            trips['route_id'].append(field(trip, 'route_id'))
+            trips['direction_id'].append(field(trip, 'direction_id', np.nan))
+            trips['train_number'].append(field(ovapi, 'trip_short_name'))
+            trips['relationship'].append(trip.schedule_relationship)
+            count = 0
+            for stu in trip_update.stop_time_update:
+                if not stu.HasField('stop_id'):
+                    continue
+                count += 1
+                ovapi = stu.Extensions[ovapi_stop_time] if stu.HasExtension(ovapi_stop_time) else None
+                stops['stop_id'].append(stu.stop_id)
+                append_stop_time_event(stops, 'arrival', stu)
+                append_stop_time_event(stops, 'departure', stu)
+                stops['station_id'].append(field(ovapi, 'station_id'))
+                stops['scheduled_track'].append(field(ovapi, 'scheduled_track'))
+                stops['relationship'].append(stu.schedule_relationship)
+            counts.append(count)
+
+        start_times = service_datetime(trips.pop('start_date'), trips.pop('start_time'))
+        ids = repeat(trips['id'], counts)
+        df = pd.DataFrame({'id': ids, 'trip_id': ids, 'RT_id': repeat(trips['RT_id'], counts),
+                           'start_time': repeat(start_times, counts), 'route_id': repeat(trips['route_id'], counts),
+                           'direction_id': nullable_int(repeat(trips['direction_id'], counts)),
+                           'stop_id': np.asarray(stops['stop_id'], dtype=object),
+                           'arrival_time': epoch_to_datetime(stops['arrival_time']),
+                           'arrival_delay': nullable_int(stops['arrival_delay']),
+                           'departure_time': epoch_to_datetime(stops['departure_time']),
+                           'departure_delay': nullable_int(stops['departure_delay']),
+                           'schedule_relationship': schedule_relationships(repeat(trips['relationship'], counts),
+                                                                           stops['relationship'])})
+        df['timestamp'] = epoch_to_datetime([timestamp])[0]
+        df['station_id'] = np.asarray(stops['station_id'], dtype=object)
+        df['train_number'] = repeat(trips['train_number'], counts)
+        df['scheduled_track'] = np.asarray(stops['scheduled_track'], dtype=object)
+        return df
+
+    def decode_vehicle_positions(self, entities, timestamp):
+        """
+        Decode entities of a vehiclePositions feed, one row per vehicle. The OVapi delay is read by descriptor.
+        """
+        import geopandas as gpd
+        extensions = realtime_modules()[1]
+        ovapi_trip, ovapi_vehicle = extensions.ovapi_tripdescriptor, extensions.ovapi_vehicle_position
+        cols = {'id': [], 'RT_id': [], 'trip_id': [], 'start_date': [], 'start_time': [], 'route_id': [],
+                'direction_id': array('d'), 'latitude': array('d'), 'longitude': array('d'),
+                'current_stop_seq': array('d'), 'timestamp': array('d'), 'label': [], 'delay': array('d')}
+        for entity in entities:
+            vehicle = entity.vehicle
+            trip = vehicle.trip
+            ovapi = trip.Extensions[ovapi_trip] if trip.HasExtension(ovapi_trip) else None
+            cols['id'].append(entity.id)
+            cols['RT_id'].append(field(ovapi, 'realtime_trip_id'))
+            cols['trip_id'].append(field(trip, 'trip_id'))
+            cols['start_date'].append(field(trip, 'start_date'))
+            cols['start_time'].append(field(trip, 'start_time'))
+            cols['route_id'].append(field(trip, 'route_id'))
+            cols['direction_id'].append(field(trip, 'direction_id', np.nan))
+            position = vehicle.HasField('position')
+            cols['latitude'].append(vehicle.position.latitude if position else np.nan)
+            cols['longitude'].append(vehicle.position.longitude if position else np.nan)
+            cols['current_stop_seq'].append(field(vehicle, 'current_stop_sequence', np.nan))
+            cols['timestamp'].append(field(vehicle, 'timestamp', np.nan))
+            cols['label'].append(field(vehicle.vehicle, 'label') if vehicle.HasField('vehicle') else None)
+            ovapi = vehicle.Extensions[ovapi_vehicle] if vehicle.HasExtension(ovapi_vehicle) else None
+            cols['delay'].append(field(ovapi, 'delay', np.nan))
+
+        df = pd.DataFrame({'id': cols['id'], 'RT_id': cols['RT_id'], 'trip_id': cols['trip_id'],
+                           'start_time': service_datetime(cols['start_date'], cols['start_time']),
+                           'route_id': cols['route_id'], 'direction_id': nullable_int(cols['direction_id']),
+                           'latitude': np.asarray(cols['latitude']), 'longitude': np.asarray(cols['longitude']),
+                           'current_stop_seq': nullable_int(cols['current_stop_seq']),
+                           'timestamp': epoch_to_datetime(cols['timestamp']), 'label': cols['label'],
+                           'delay': nullable_int(cols['delay'])})
+        return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
+
+    def decode_alerts(self, entities, timestamp):
+        """
+        Decode entities of an alerts feed, one row per alert and active period, and the mapping of the alerts to
+        the informed stops and routes. Cause and effect names are taken from the protobuf enums.
+
+        :return: Tuple with the alerts, alerts to stops and alerts to routes frames
+        """
+        gtfs_realtime_pb2 = realtime_modules()[0]
         updates = []
         routemapping = []
         stopmapping = []
-        timestamp = alerts['header']['timestamp']
-        causes = {0: 'UNKNOWN_CAUSE', 1: 'OTHER_CAUSE', 2: 'TECHNICAL_PROBLEM', 3: 'STRIKE', 4: 'DEMONSTRATION',
-                  5: 'ACCIDENT', 6: 'HOLIDAY', 7: 'WEATHER', 8: 'MAINTENANCE', 9: 'CONSTRUCTION',
-                  10: 'POLICE_ACTIVITY', 11: 'MEDICAL_EMERGENCY'}
-        effects = {-1: None, 0: 'NO_SERVICE', 1: 'REDUCED_SERVICE', 2: 'SIGNIFICANT_DELAYS', 3: 'DETOUR',
-                   4: 'ADDITIONAL_SERVICE', 5: 'MODIFIED_SERVICE', 6: 'OTHER_EFFECT',
-                   7: 'UNKNOWN_EFFECT', 8: 'STOP_MOVED'}
-        for al in alerts['entity']:
-            aid = al['id']
-            alert = al['alert']
-            cause = int(alert['cause']) if 'cause' in alert else 0
-            effect = int(alert['effect']) if 'effect' in alert else -1
-            header_text = alert['header_text']['translation'][0]['text']
-            description_text = alert['description_text']['translation'][0]['text']
-            for ap in alert['active_period']:
-                start = ap['start']
-                end = ap['end']
-                if 'informed_entity' in alert:
-                    for inf in alert['informed_entity']:
-                        informed_stop = inf['stop_id']
-                        stopmapping.append({'alert_id': aid, 'stop_id': informed_stop, 'start': start, 'end': end})
-                        if 'route_id' in inf:
-                            informed_route = inf['route_id']
-                            routemapping.append({'alert_id': aid, 'route_id': int(informed_route),
-                                                 'start': start, 'end': end})
-                updates.append({'id': aid, 'timestamp': timestamp,
-                                'cause_id': cause, 'cause': causes[cause], 'effect_id': effect,
-                                'effect': effects[effect], 'start': start, 'end': end,
-                                'header': header_text, 'description': description_text})
-        df_alerts = pd.DataFrame(updates)
+        for entity in entities:
+            alert = entity.alert
+            header_text = alert.header_text.translation[0].text if alert.header_text.translation else None
+            description_text = \
+                alert.description_text.translation[0].text if alert.description_text.translation else None
+            for period in alert.active_period:
+                start = field(period, 'start', np.nan)
+                end = field(period, 'end', np.nan)
+                for informed in alert.informed_entity:
+                    if informed.HasField('stop_id'):
+                        stopmapping.append({'alert_id': entity.id, 'stop_id': informed.stop_id,
+                                            'start': start, 'end': end})
+                    if informed.HasField('route_id'):
+                        routemapping.append({'alert_id': entity.id, 'route_id': informed.route_id,
+                                             'start': start, 'end': end})
+                updates.append({'id': entity.id, 'timestamp': timestamp,
+                                'cause_id': alert.cause, 'cause': gtfs_realtime_pb2.Alert.Cause.Name(alert.cause),
+                                'effect_id': alert.effect,
+                                'effect': gtfs_realtime_pb2.Alert.Effect.Name(alert.effect),
+                                'start': start, 'end': end, 'header': header_text, 'description': description_text})
+        df_alerts = pd.DataFrame(updates, columns=['id', 'timestamp', 'cause_id', 'cause', 'effect_id', 'effect',
+                                                   'start', 'end', 'header', 'description'])
         df_alerts = self.convert_times(df_alerts, ['timestamp', 'start', 'end'])
-        df_alerts_to_stops = pd.DataFrame(stopmapping)
+        df_alerts_to_stops = pd.DataFrame(stopmapping, columns=['alert_id', 'stop_id', 'start', 'end'])
         df_alerts_to_stops = self.convert_times(df_alerts_to_stops, ['start', 'end'])
-        df_alerts_to_routes = pd.DataFrame(routemapping)
+        df_alerts_to_routes = pd.DataFrame(routemapping, columns=['alert_id', 'route_id', 'start', 'end'])
         df_alerts_to_routes = self.convert_times(df_alerts_to_routes, ['start', 'end'])
-        self.alerts = df_alerts
-        self.alerts_to_routes = df_alerts_to_routes
-        self.alerts_to_stops = df_alerts_to_stops
-        print("Alerts            : {}".format(len(self.alerts)))
+        return df_alerts, df_alerts_to_stops, df_alerts_to_routes
+
+    def update_realtime(self, max_age=15):
+        """
+        Update the realtime information from GTFS. Only the entities that changed since the previous
+        update are decoded, the changes per feed are available in changes (see RealtimeState). A feed
+        with the same timestamp as the applied feed is not applied again.
+        Download, parse, decode and index of every feed are measured, see instrumentation.
+        :param max_age: Maxium age of cache file (in mnutes)
+        :return:
+        """
+        with self.stage('update:realtime'):
+            results = self.fetch_realtime(max_age)
+            for result in results.values():
+                if result.status == 'error':
+                    print('Error downloading {} : {}'.format(result.url, result.error))
+
+            for feed in REALTIME_FEEDS:
+                # A feed file that was not downloaded again and still holds the applied feed is not parsed
+                if results[feed].status in ['cached', 'not_modified'] and self.realtime[feed].timestamp:
+                    header = self.read_feed_header(feed + '.pb')
+                    if header is not None and header.timestamp == self.realtime[feed].timestamp:
+                        self.changes[feed] = ChangeSet([], [], [])
+                        continue
+                self.apply_feed(feed, self.read_feed(feed + '.pb'))
+
+    def apply_feed(self, feed, message):
+        """
+        Apply a parsed realtime feed to its realtime state and update the corresponding frames
+        (trip_updates, train_updates, vehicle_positions or the alert frames)
+
+        :param str feed: The feed, one of REALTIME_FEEDS
+        :param message: The FeedMessage
+        :return: ChangeSet of the update
+        """
+        state = self.realtime[feed]
+        if feed in ['tripUpdates', 'vehiclePositions']:
+            self.predicted_delays = None
+        with self.stage('decode:' + feed, rows_in=len(message.entity)) as stage:
+            self.changes[feed] = state.update(message)
+            for attribute, frame in zip(REALTIME_FRAMES[feed], state.frames):
+                setattr(self, attribute, frame)
+            stage['rows_out'] = len(state.frames[0])
+        if feed == 'vehiclePositions':
+            with self.stage('index:vehicle_positions', rows_in=len(self.vehicle_positions)):
+                self.vehicle_locations = SpatialIndex(self.vehicle_positions.longitude,
+                                                      self.vehicle_positions.latitude)
+        if feed == 'alerts':
+            with self.stage('index:alerts', rows_in=len(self.alerts_to_stops) + len(self.alerts_to_routes)):
+                self.stop_alerts = AlertIndex(self.alerts_to_stops, 'stop_id')
+                self.route_alerts = AlertIndex(self.alerts_to_routes, 'route_id')
+        return self.changes[feed]
+
+    def get_active_alerts(self, stop_ids=None, route_ids=None, at=None):
+        """
+        Alerts active at a moment for the given stops and/or routes
+
+        :param stop_ids: The stops to get the alerts for
+        :param route_ids: The routes to get the alerts for
+        :param datetime at: The moment, defaults to now
+        :return: The active periods of the alerts from alerts
+        """
+        at = at or datetime.now()
+        ids = []
+        if stop_ids is not None:
+            ids.append(self.stop_alerts.active(stop_ids, at))
+        if route_ids is not None:
+            ids.append(self.route_alerts.active(route_ids, at))
+        ids = np.concatenate(ids) if ids else []
+        alerts = self.alerts[self.alerts.id.isin(ids)]
+        return alerts[(alerts.start.isnull() | (alerts.start <= at)) & (alerts.end.isnull() | (alerts.end >= at))]
+
+    def change_summary(self, feed):
+        """
+        Short description of the changes in the last update of a feed, e.g. (+3 ~10 -1)
+        """
+        changes = self.changes[feed]
+        return '(+{} ~{} -{})'.format(len(changes.inserted), len(changes.changed), len(changes.removed))
+
+    def find_stops(self, name, mode='substring', fold=False):
+        """
+        Look up stops by name using the stop name index. The result holds the stop_id and
+        parent_station of every match.
+
+        :param str name: The (part of the) name to look for
+        :param str mode: 'exact', 'prefix' or 'substring'
+        :param bool fold: Ignore case and accents
+        :return: Matching rows of stops
+        """
+        return self.stop_table.iloc[self.stop_index.lookup(name, mode, fold)]
+
+    def get_stops_in_bbox(self, bbox):
+        """
+        Stops within a bounding box (min_lon, min_lat, max_lon, max_lat)
+        """
+        return self.stops.iloc[self.stop_locations.bbox(*bbox)]
+
+    def get_stops_near(self, lon, lat, radius=None, k=None):
+        """
+        Stops within radius meters of a location and/or the k nearest stops, nearest first.
+        The distance in meters is added as column distance.
+        """
+        if k:
+            positions, distances = self.stop_locations.nearest(lon, lat, k, max_distance=radius)
+        else:
+            positions, distances = self.stop_locations.within(lon, lat, radius)
+        return self.stops.iloc[positions].assign(distance=distances)
+
+    def get_vehicles_in_bbox(self, bbox):
+        """
+        Vehicle positions within a bounding box (min_lon, min_lat, max_lon, max_lat)
+        """
+        return self.vehicle_positions.iloc[self.vehicle_locations.bbox(*bbox)]
+
+    def snap_vehicles(self, max_distance=500, platforms=True):
+        """
+        Add the nearest stop (stop_id, stop_name and distance in meters) to all vehicle positions
+
+        :param int max_distance: Only snap vehicles within this many meters of a stop
+        :param bool platforms: Only snap to platforms / stop points (location_type 0), not to stations
+        """
+        index = self.platform_locations if platforms else self.stop_locations
+        positions, distances = index.snap(self.vehicle_positions.longitude, self.vehicle_positions.latitude,
+                                          max_distance)
+        stops = self.stop_table[['stop_id', 'stop_name']].iloc[np.maximum(positions, 0)]
+        stops = stops.set_index(self.vehicle_positions.index).where(pd.Series(positions >= 0,
+                                                                               self.vehicle_positions.index), axis=0)
+        return self.vehicle_positions.assign(stop_id=stops.stop_id, stop_name=stops.stop_name, distance=distances)
 
     def get_train_departures_at(self, station):
-        df = self.train_updates.merge(self.stops, on='stop_id')
+        stops = self.find_stops(station, mode='exact')
+        df = self.train_updates[self.train_updates.stop_id.isin(stops.stop_id)]
+        df = df.merge(stops, on='stop_id')
         df = df.merge(self.trips, on='trip_id')
-        df = df[df.stop_name == station]
         df = df.loc[df.departure_time.notnull()].sort_values('departure_time')
         df = df[df.platform_code.notnull() & (df['departure_time'] > datetime.now())]
         df['departure_time'] = df['departure_time'].apply(lambda x: x.replace(tzinfo=None))
         return df
 
     def get_departures_at(self, halte):
-        df = self.trip_updates.merge(self.stoptimes[['trip_id', 'stop_sequence', 'stop_id']])
-        df = df.merge(self.stops, on='stop_id')
+        stops = self.find_stops(halte)
+        stoptimes = self.stoptimes[self.stoptimes.stop_id.isin(stops.stop_id)]
+        df = self.trip_updates.merge(stoptimes[['trip_id', 'stop_sequence', 'stop_id']])
+        df = df.merge(stops, on='stop_id')
         df = df.merge(self.trips, on='trip_id')
-        df = df[df.stop_name.str.contains(halte)]
         return df
 
     def get_planned_stops(self, halte):
+        stops = self.find_stops(halte)
         planned = pd.merge(
             self.stoptimes[['trip_id', 'stop_sequence', 'stop_id', 'arrival_time',
                             'departure_time']],
-            self.stops[(self.stops.stop_name.str.contains(halte)) & (self.stops.stop_code.notnull())]
-            [['stop_id', 'stop_code', 'stop_name', 'platform_code']],
+            stops[stops.stop_code.notnull()][['stop_id', 'stop_code', 'stop_name', 'platform_code']],
             on=['stop_id']
         )
         planned = planned.merge(self.trips[['trip_id', 'route_short_name', 'trip_short_name', 'trip_headsign']])
@@ -492,24 +2021,31 @@ class GTFS:
         return planned
 
     def get_actual_stops(self, halte):
-        actual = self.stops[['stop_id', 'stop_code', 'stop_name']][self.stops.stop_name.str.contains(halte)]
-        actual = actual.merge(self.stoptimes[['trip_id', 'stop_sequence', 'stop_id']])
-        actual = actual.merge(self.trip_updates[['RT_id', 'trip_id', 'route_id', 'direction_id', 'stop_sequence',
-                                                 'arrival_time', 'departure_time', 'departure_delay']])
+        stops = self.find_stops(halte)[['stop_id', 'stop_code', 'stop_name']]
+        updates = self.trip_updates[['RT_id', 'trip_id', 'stop_sequence', 'arrival_time', 'departure_time',
+                                     'departure_delay']]
+        # The stop of every update is found through the (trip_id, stop_sequence) index on stoptimes
+        positions = self.trip_stop_index.lookup(updates.trip_id, updates.stop_sequence)
+        actual = updates[positions >= 0].assign(stop_id=self.stoptimes.stop_id.values[positions[positions >= 0]])
+        actual = actual[actual.stop_id.isin(stops.stop_id)].merge(stops, on='stop_id')
         actual = actual.merge(self.trips[['trip_id', 'route_short_name', 'trip_headsign']])
         actual = actual[['stop_id', 'stop_code', 'stop_name', 'trip_id', 'stop_sequence',
                          'route_short_name', 'trip_headsign', 'arrival_time', 'departure_time',
                          'departure_delay', 'RT_id']]
         return actual
 
-    def get_departures_at_stop(self, halte):
-        planned = self.get_planned_stops(halte)
-        actual = self.get_actual_stops(halte)
-        tt = planned.merge(actual[['trip_id', 'departure_time', 'departure_delay', 'RT_id']],
-                           on='trip_id', how='left', suffixes=['_planned', '_actual'])
-        tt.departure_time_actual.fillna(tt.departure_time_planned, inplace=True)
-        tt.departure_delay.fillna(0, inplace=True)
-        tt['RT'] = tt.RT_id.notnull()
-        tt = tt.drop(columns=['stop_code', 'RT_id', 'arrival_time', 'departure_time_planned'])
-        tt = tt.rename(columns={'departure_time_actual': 'departure_time'})
-        return tt.sort_values('departure_time')
+    def get_departures_at_stop(self, halte, after=None, n=None):
+        """
+        Departure board for the stops matching halte, with realtime departure times where available.
+
+        :param str halte: (Part of) the stop name
+        :param datetime after: Only departures after this time, all departures of the day if None
+        :param int n: Maximum number of departures, all departures if None
+        :return: Departures sorted on departure time
+        """
+        stops = self.find_stops(halte)
+        stops = stops[stops.stop_code.notnull()][['stop_id', 'stop_name', 'platform_code']]
+        tt = self.get_timeline(stops.stop_id, after=after, n=n)
+        tt = tt.merge(stops, on='stop_id')
+        return tt[['stop_id', 'stop_name', 'platform_code', 'trip_id', 'stop_sequence', 'route_short_name',
+                   'trip_short_name', 'trip_headsign', 'departure_time', 'departure_delay', 'RT']]
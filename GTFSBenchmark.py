@@ -0,0 +1,159 @@
+"""
+Benchmark of the GTFS class on synthetic feeds. Times and memory-profiles loading the static feed, applying
+the realtime feeds and the queries, e.g.
+
+    python GTFSBenchmark.py --scale medium --repeat 5
+"""
+import os
+import io
+import glob
+import shutil
+import time
+import argparse
+import tracemalloc
+import contextlib
+import tempfile
+import pandas as pd
+from datetime import datetime, timedelta
+from GTFS import GTFS, DAY_TABLES
+import GTFSSynthetic
+
+SCALES = {
+    'small': dict(stations=500, routes=100, trips=2000, stops_per_trip=15, points_per_shape=100),
+    'medium': dict(stations=3000, routes=800, trips=30000, stops_per_trip=20, points_per_shape=300),
+    'large': dict(stations=10000, routes=3000, trips=150000, stops_per_trip=25, points_per_shape=500),
+}
+
+
+def measure(stage, func, repeat=1, setup=None):
+    """
+    Time a stage and measure its peak memory. The timings run without tracing, the peak memory is
+    measured in one additional traced run.
+
+    :param str stage: Name of the stage
+    :param func: Function to measure
+    :param int repeat: Number of timed runs
+    :param setup: Function called before every run, not measured
+    :return: Dictionary with the stage, the mean and minimum wall time in seconds and the peak memory in MB
+    """
+    times = []
+    for _ in range(repeat + 1):
+        if setup:
+            setup()
+        traced = len(times) == repeat
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        elapsed = time.perf_counter() - start
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            times.append(elapsed)
+    return {'stage': stage, 'mean': sum(times) / len(times), 'min': min(times), 'peak_mb': peak / 2 ** 20}
+
+
+def remove_caches():
+    """
+    Remove the cached tables to force a cold load of the static feed
+    """
+    for filename in glob.glob('*.feather'):
+        os.remove(filename)
+
+
+def use_feeds(directory):
+    """
+    Copy the realtime feeds of a directory to the current directory, where update_realtime reads them
+    """
+    for filename in glob.glob(os.path.join(directory, '*.pb')):
+        shutil.copy(filename, os.path.basename(filename))
+
+
+def run_benchmark(scale='small', repeat=3, day=None):
+    """
+    Generate a synthetic feed in the current directory and benchmark the stages and queries on it
+
+    :param str scale: One of SCALES
+    :param int repeat: Number of timed runs per stage
+    :param str day: Service day as YYYY-MM-DD, defaults to today
+    :return: DataFrame with a row per stage
+    """
+    day = day or datetime.now().strftime('%Y-%m-%d')
+    results = []
+    start = time.perf_counter()
+    tables = GTFSSynthetic.generate_static('gtfs-nl.zip', day=day, **SCALES[scale])
+    timestamp = int(time.time())
+    for directory, seed in [('first', 1), ('changed', 2)]:
+        os.makedirs(directory, exist_ok=True)
+        GTFSSynthetic.generate_realtime(tables, directory, day=day, seed=seed, timestamp=timestamp)
+        timestamp += 60
+    use_feeds('first')
+    print('Generated {} scale feed in {:.1f} s'.format(scale, time.perf_counter() - start))
+
+    gtfs = GTFS(verbose=False)
+    results.append(measure('update_static (lazy)', lambda: gtfs.update_static(day), repeat))
+
+    def load_static():
+        gtfs.update_static(day)
+        gtfs.preload()
+
+    def load_day():
+        gtfs.select_day(day)
+        gtfs.preload(*DAY_TABLES)
+
+    results.append(measure('update_static + preload (cold)', load_static, repeat, setup=remove_caches))
+    results.append(measure('update_static + preload (cached)', load_static, repeat))
+    results.append(measure('select_day + preload', load_day, repeat))
+    results.append(measure('update_realtime (new)', lambda: gtfs.update_realtime(max_age=24 * 60),
+                           repeat, setup=gtfs.reset_realtime))
+    results.append(measure('update_realtime (unchanged)', lambda: gtfs.update_realtime(max_age=24 * 60),
+                           repeat))
+
+    # A second version of the realtime feeds, about half of the entities change. The first version is
+    # applied before every run, so only the update to the second version is measured.
+    def apply_first():
+        gtfs.reset_realtime()
+        use_feeds('first')
+        gtfs.update_realtime(max_age=24 * 60)
+        use_feeds('changed')
+
+    results.append(measure('update_realtime (changed)', lambda: gtfs.update_realtime(max_age=24 * 60),
+                           repeat, setup=apply_first))
+
+    station = tables['stops.txt'].stop_name.iloc[0]
+    at = datetime.strptime(day, '%Y-%m-%d') + timedelta(hours=8)
+    stop_ids = gtfs.stops.stop_id.iloc[:50]
+    route_ids = gtfs.routes.route_id.iloc[:50]
+    lon, lat = gtfs.stops.stop_lon.iloc[0], gtfs.stops.stop_lat.iloc[0]
+    queries = [
+        ('find_stops', lambda: gtfs.find_stops(station[:9])),
+        ('get_departures_at_stop', lambda: gtfs.get_departures_at_stop(station, after=at, n=10)),
+        ('get_train_departures_at', lambda: gtfs.get_train_departures_at(station)),
+        ('get_departures_at', lambda: gtfs.get_departures_at(station)),
+        ('get_planned_stops', lambda: gtfs.get_planned_stops(station)),
+        ('get_actual_stops', lambda: gtfs.get_actual_stops(station)),
+        ('get_active_alerts', lambda: gtfs.get_active_alerts(stop_ids, route_ids, at=at)),
+        ('get_stops_near', lambda: gtfs.get_stops_near(lon, lat, radius=5000)),
+        ('get_vehicles_in_bbox', lambda: gtfs.get_vehicles_in_bbox((4.5, 51.5, 5.5, 52.5))),
+        ('snap_vehicles', lambda: gtfs.snap_vehicles()),
+    ]
+    for stage, func in queries:
+        results.append(measure(stage, func, repeat))
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the GTFS class on a synthetic feed')
+    parser.add_argument('--scale', choices=SCALES.keys(), default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--day', help='Service day as YYYY-MM-DD, defaults to today')
+    parser.add_argument('--dir', help='Working directory for the feeds, defaults to a temporary directory')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(args.dir or tmp)
+        report = run_benchmark(args.scale, args.repeat, args.day)
+    pd.set_option('display.width', 200)
+    print(report.to_string(index=False, float_format='{:.4f}'.format))
@@ -0,0 +1,94 @@
+"""
+Streaming GeoJSON export. Features are written one at a time, either as a FeatureCollection or as
+newline-delimited GeoJSON (one feature per line), so the memory use does not grow with the export.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class GeoJSONWriter:
+    """
+    Writes features to a file as they are produced. Use as context manager, the FeatureCollection is
+    closed on exit. The features are written to a temporary file that only replaces the file when the
+    export completes, so a failed export leaves the previous file in place.
+    """
+
+    def __init__(self, filename, ndjson=False, precision=6):
+        """
+        :param str filename: The file to write
+        :param bool ndjson: Write newline-delimited GeoJSON instead of a FeatureCollection
+        :param int precision: Number of decimals of the coordinates, as the geojson package
+        """
+        self.filename = filename
+        self.ndjson = ndjson
+        self.precision = precision
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open(self.filename + '.tmp', 'w')
+        if not self.ndjson:
+            self.file.write('{"type": "FeatureCollection", "features": [')
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None and not self.ndjson:
+            self.file.write(']}')
+        self.file.close()
+        self.file = None
+        if exc[0] is None:
+            os.replace(self.filename + '.tmp', self.filename)
+        else:
+            os.remove(self.filename + '.tmp')
+        return False
+
+    def write(self, geometry, properties):
+        """
+        Write a feature
+
+        :param dict geometry: GeoJSON geometry
+        :param dict properties: Properties of the feature
+        """
+        feature = json.dumps({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+        if self.ndjson:
+            self.file.write(feature + '\n')
+        else:
+            self.file.write((', ' if self.count else '') + feature)
+        self.count += 1
+
+    def write_line(self, coordinates, properties):
+        """
+        Write a LineString feature
+
+        :param coordinates: Array with a row per point (lon, lat and optional further values)
+        :param dict properties: Properties of the feature
+        """
+        coordinates = np.round(np.asarray(coordinates, dtype=float), self.precision)
+        self.write({'type': 'LineString', 'coordinates': coordinates.tolist()}, properties)
+
+    def write_lines(self, coordinates, bounds, properties):
+        """
+        Write a LineString feature per part of the coordinates
+
+        :param coordinates: Array with a row per point of all lines, the points of a line are consecutive
+        :param bounds: Position of the first point of every line, followed by the number of points
+        :param properties: Frame with a row of properties per line
+        """
+        for start, end, row in zip(bounds[:-1], bounds[1:], properties.itertuples(index=False)):
+            self.write_line(coordinates[start:end], row._asdict())
+
+
+def segments(df, keys):
+    """
+    Group the rows of a frame on keys in one pass. Groups are in order of first appearance of the first
+    key and within it of the combined keys, rows keep their order within a group.
+
+    :return: Tuple of the row positions in group order and the bounds of the groups in it
+    """
+    first = pd.factorize(df[keys[0]])[0]
+    combined = df.groupby(keys, sort=False).ngroup().to_numpy()
+    order = np.lexsort((combined, first))
+    changes = np.flatnonzero(combined[order][1:] != combined[order][:-1]) + 1
+    return order, np.concatenate([[0], changes, [len(df)]]) if len(df) else np.array([0])
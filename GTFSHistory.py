@@ -0,0 +1,229 @@
+import os
+import glob
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from GTFS import epoch_to_datetime
+
+# Per history table: the realtime feed it comes from, the column with the feed entity id, the columns
+# identifying an observation and the columns that are ignored when comparing observations
+HISTORY_TABLES = {
+    'trip_updates': {'feed': 'tripUpdates', 'entity': 'id', 'key': ['trip_id', 'start_time', 'stop_sequence'],
+                     'ignore': ['timestamp']},
+    'train_updates': {'feed': 'trainUpdates', 'entity': 'id', 'key': ['id', 'start_time', 'stop_id'],
+                      'ignore': ['timestamp']},
+    'vehicle_positions': {'feed': 'vehiclePositions', 'entity': 'id', 'key': ['id'], 'ignore': []},
+}
+
+
+class GTFSHistory:
+    """
+    Append-only history of the realtime trip updates, train updates and vehicle positions.
+    Observations are written as Parquet files partitioned by day and hour of the feed timestamp:
+    <directory>/<table>/date=YYYY-MM-DD/hour=HH/<part>.parquet. An observation is only written when it
+    differs from the previous observation with the same key, e.g. the same (trip, stop_sequence).
+    Compaction merges the hourly files of a completed day into one daily file, dropping repeated
+    observations, and removes the hourly files.
+    """
+
+    def __init__(self, directory='history'):
+        self.directory = directory
+        # Hash of the last written observation per key hash, per table, kept for the current day
+        self.last = {table: pd.Series(dtype='uint64') for table in HISTORY_TABLES}
+        self.day = None
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def observation_hashes(self, table, df):
+        """
+        Hash of the key and of the observed values of every row
+        """
+        config = HISTORY_TABLES[table]
+        values = [c for c in df.columns if c not in config['key'] + config['ignore'] + ['geometry']]
+        keys = pd.util.hash_pandas_object(df[config['key']].astype(str), index=False).to_numpy()
+        observed = pd.util.hash_pandas_object(df[values].astype(str), index=False).to_numpy()
+        return keys, observed
+
+    def append(self, table, df, timestamp=None):
+        """
+        Append observations to the history, observations equal to the previous observation with the
+        same key are skipped
+
+        :param str table: trip_updates, train_updates or vehicle_positions
+        :param df: The observations
+        :param datetime timestamp: Time of the feed, used for observations without a timestamp (e.g. a
+                                   vehicle position without one). These are skipped if not given.
+        :return: Number of rows written
+        """
+        if timestamp is not None:
+            df = df.assign(timestamp=df.timestamp.fillna(timestamp))
+        df = df[df.timestamp.notnull().to_numpy()]
+        if len(df) == 0:
+            return 0
+        keys, observed = self.observation_hashes(table, df)
+        with self.lock:
+            previous = self.last[table].reindex(keys).to_numpy()
+            new = previous != observed
+            if not new.any():
+                return 0
+            last = pd.concat([self.last[table], pd.Series(observed[new], index=keys[new])])
+            self.last[table] = last[~last.index.duplicated(keep='last')]
+        df = pd.DataFrame(df.drop(columns='geometry', errors='ignore'))[new]
+
+        hours = df.timestamp.dt.floor('h')
+        for hour, rows in df.groupby(hours):
+            directory = os.path.join(self.directory, table, hour.strftime('date=%Y-%m-%d'), hour.strftime('hour=%H'))
+            os.makedirs(directory, exist_ok=True)
+            pq.write_table(to_arrow(rows), os.path.join(directory, uuid.uuid4().hex + '.parquet'))
+        return len(df)
+
+    def record(self, snapshot):
+        """
+        Append the rows of the new and changed entities of a poller snapshot (see GTFSPoller),
+        can be registered as listener of the poller
+        """
+        for table, config in HISTORY_TABLES.items():
+            if config['feed'] == snapshot.feed:
+                df = snapshot.frames[table]
+                changed = snapshot.changes.inserted + snapshot.changes.changed
+                self.append(table, df[df[config['entity']].astype(str).isin(changed)],
+                            epoch_to_datetime([snapshot.timestamp])[0])
+
+    def files(self, table, start, end):
+        """
+        Files of a table holding observations between start and end, daily files are used where
+        a day has been compacted
+        """
+        files = []
+        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day <= end:
+            directory = os.path.join(self.directory, table, day.strftime('date=%Y-%m-%d'))
+            daily = os.path.join(directory, 'day.parquet')
+            if os.path.exists(daily):
+                files.append(daily)
+            for hourdir in sorted(glob.glob(os.path.join(directory, 'hour=*'))):
+                hour = day + timedelta(hours=int(hourdir[-2:]))
+                if hour + timedelta(hours=1) > start and hour <= end:
+                    files.extend(sorted(glob.glob(os.path.join(hourdir, '*.parquet'))))
+            day += timedelta(days=1)
+        return files
+
+    def scan(self, table, start, end, columns=None):
+        """
+        Observations of a table with a feed timestamp between start and end. Only the partitions in
+        the time range are read.
+
+        :param str table: trip_updates, train_updates or vehicle_positions
+        :param datetime start: Start of the time range
+        :param datetime end: End of the time range (inclusive)
+        :param list columns: Columns to read, all columns if None
+        :return: DataFrame sorted on timestamp
+        """
+        files = self.files(table, start, end)
+        if not files:
+            return pd.DataFrame(columns=columns)
+        dataset = ds.dataset(files, format='parquet')
+        timestamp = ds.field('timestamp')
+        condition = (timestamp >= pa.scalar(start, pa.timestamp('us'))) & \
+                    (timestamp <= pa.scalar(end, pa.timestamp('us')))
+        df = dataset.to_table(columns=columns, filter=condition).to_pandas()
+        return df.sort_values('timestamp', ignore_index=True) if 'timestamp' in df.columns else df
+
+    def compact(self, table, day):
+        """
+        Merge the hourly files of a day into one daily file, dropping observations equal to the previous
+        observation with the same key
+
+        :param str table: trip_updates, train_updates or vehicle_positions
+        :param datetime day: The day to compact
+        :return: Number of rows in the daily file
+        """
+        directory = os.path.join(self.directory, table, day.strftime('date=%Y-%m-%d'))
+        hourdirs = sorted(glob.glob(os.path.join(directory, 'hour=*')))
+        if not hourdirs:
+            return 0
+        daily = os.path.join(directory, 'day.parquet')
+        files = ([daily] if os.path.exists(daily) else []) + \
+            [f for d in hourdirs for f in sorted(glob.glob(os.path.join(d, '*.parquet')))]
+        df = ds.dataset(files, format='parquet').to_table().to_pandas()
+        df = df.sort_values('timestamp', kind='stable', ignore_index=True)
+        keys, observed = self.observation_hashes(table, df)
+        order = np.argsort(keys, kind='stable')
+        keys, observed = keys[order], observed[order]
+        keep = np.empty(len(df), dtype=bool)
+        keep[order] = np.concatenate([[True], (keys[1:] != keys[:-1]) | (observed[1:] != observed[:-1])])
+        df = df[keep]
+        pq.write_table(to_arrow(df), daily + '.tmp')
+        os.replace(daily + '.tmp', daily)
+        for d in hourdirs:
+            shutil.rmtree(d)
+        return len(df)
+
+    def compact_all(self, before=None):
+        """
+        Compact all days before the given day (default: today) that still have hourly files.
+        The observations kept for skipping repeated observations are only kept for the current day,
+        they are dropped when the day rolls over.
+        """
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        before = before or today
+        with self.lock:
+            if self.day != today:
+                self.last = {table: pd.Series(dtype='uint64') for table in HISTORY_TABLES}
+                self.day = today
+        for table in HISTORY_TABLES:
+            for directory in sorted(glob.glob(os.path.join(self.directory, table, 'date=*'))):
+                day = datetime.strptime(os.path.basename(directory), 'date=%Y-%m-%d')
+                if day < before:
+                    self.compact(table, day)
+
+    def start_compaction(self, interval=3600):
+        """
+        Compact completed days in a background thread every interval seconds
+        """
+        def run():
+            while not self.stopped.wait(interval):
+                try:
+                    self.compact_all()
+                except Exception as e:
+                    print('Error compacting history : {}'.format(e))
+
+        self.stopped.clear()
+        self.thread = Thread(target=run, name='GTFSHistory', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background compaction
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+def to_arrow(df):
+    """
+    Convert observations to an Arrow table with a stable schema: IDs as strings, timestamps in
+    microseconds and columns without any value as strings
+    """
+    df = df.copy()
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype(object).where(df[c].notnull(), None)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for f in table.schema:
+        if pa.types.is_null(f.type):
+            f = f.with_type(pa.string())
+        elif pa.types.is_timestamp(f.type):
+            f = f.with_type(pa.timestamp('us'))
+        fields.append(f)
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
@@ -0,0 +1,140 @@
+import heapq
+import time
+from collections import deque, namedtuple
+from threading import Event, Thread
+from GTFS import GTFS, REALTIME_FEEDS, REALTIME_FRAMES
+from GTFSHistory import GTFSHistory
+from GTFSPunctuality import GTFSPunctuality
+
+# A parsed realtime feed as published by the poller
+Snapshot = namedtuple('Snapshot', ['feed', 'timestamp', 'received', 'frames', 'changes'])
+
+
+class GTFSPoller:
+    """
+    Keeps the realtime information of a GTFS object up to date. Every feed is refreshed on its own
+    interval with a conditional request, feeds with the same header timestamp as the previous one are
+    skipped and failing feeds are retried with an exponential backoff.
+    The last snapshots of every feed are kept in a ring buffer. Snapshots are never modified after they
+    are published, so readers can use them while the poller continues.
+    """
+    intervals = {'tripUpdates': 60, 'trainUpdates': 60, 'vehiclePositions': 15, 'alerts': 300}
+
+    def __init__(self, gtfs, intervals=None, history=60, max_backoff=900, timeout=30, listeners=None):
+        """
+        :param GTFS gtfs: GTFS object with the static information loaded
+        :param dict intervals: Refresh interval in seconds per feed
+        :param int history: Number of snapshots to keep per feed
+        :param int max_backoff: Maximum time in seconds between retries of a failing feed
+        :param int timeout: Timeout in seconds per request
+        :param list listeners: Functions called with every new snapshot, e.g. GTFSHistory.record or
+                               GTFSPunctuality.record
+        """
+        self.gtfs = gtfs
+        self.intervals = {**self.intervals, **(intervals or {})}
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.listeners = listeners or []
+        self.history = {feed: deque(maxlen=history) for feed in REALTIME_FEEDS}
+        self.failures = {feed: 0 for feed in REALTIME_FEEDS}
+        self.errors = {feed: None for feed in REALTIME_FEEDS}
+        self.stopped = Event()
+        self.thread = None
+
+    def latest(self, feed):
+        """
+        The most recent snapshot of a feed, None if nothing has been received yet
+        """
+        history = self.history[feed]
+        return history[-1] if history else None
+
+    def snapshots(self, feed):
+        """
+        The snapshots of a feed in the ring buffer, oldest first
+        """
+        return list(self.history[feed])
+
+    def poll(self, feed):
+        """
+        Refresh one feed
+
+        :param str feed: The feed, one of REALTIME_FEEDS
+        :return: The new snapshot, None if the feed did not change
+        """
+        filename = feed + '.pb'
+        result = self.gtfs.download_url(self.gtfs.realtime_url + filename, filename, timeout=self.timeout)
+        if result.status == 'error':
+            raise IOError(result.error)
+        if result.status == 'not_modified' and self.latest(feed):
+            return None
+        message = self.gtfs.read_feed(filename)
+        if message.header.timestamp == self.gtfs.realtime[feed].timestamp:
+            return None
+        changes = self.gtfs.apply_feed(feed, message)
+        snapshot = Snapshot(feed, message.header.timestamp, time.time(),
+                            dict(zip(REALTIME_FRAMES[feed], self.gtfs.realtime[feed].frames)), changes)
+        self.history[feed].append(snapshot)
+        for listener in self.listeners:
+            listener(snapshot)
+        return snapshot
+
+    def next_delay(self, feed):
+        """
+        Time in seconds until the next refresh of a feed, with backoff after failures
+        """
+        if self.failures[feed] == 0:
+            return self.intervals[feed]
+        return min(self.intervals[feed] * 2 ** self.failures[feed], self.max_backoff)
+
+    def run(self):
+        """
+        Refresh the feeds until stop is called
+        """
+        schedule = [(time.monotonic(), feed) for feed in REALTIME_FEEDS]
+        heapq.heapify(schedule)
+        while not self.stopped.is_set():
+            due, feed = heapq.heappop(schedule)
+            if self.stopped.wait(max(due - time.monotonic(), 0)):
+                break
+            try:
+                snapshot = self.poll(feed)
+                self.failures[feed] = 0
+                self.errors[feed] = None
+                if snapshot:
+                    rows = len(snapshot.frames[REALTIME_FRAMES[feed][0]])
+                    print('{:<17s} : {} {}'.format(feed, rows, self.gtfs.change_summary(feed)))
+            except Exception as e:
+                self.failures[feed] += 1
+                self.errors[feed] = e
+                print('Error refreshing {} : {}'.format(feed, e))
+            heapq.heappush(schedule, (time.monotonic() + self.next_delay(feed), feed))
+
+    def start(self):
+        """
+        Start refreshing the feeds in a background thread
+        """
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name='GTFSPoller', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop refreshing the feeds and wait for the background thread to finish
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+if __name__ == '__main__':
+    gtfs = GTFS()
+    gtfs.update_static()
+    history = GTFSHistory()
+    history.start_compaction()
+    punctuality = GTFSPunctuality(gtfs)
+    poller = GTFSPoller(gtfs, listeners=[history.record, punctuality.record])
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        history.stop()
@@ -0,0 +1,202 @@
+"""
+Positions of vehicles along their trips for every minute of a service day, as used by the crowdedness
+visual. All trips are computed at once with array operations on the stop times sorted by trip, optionally
+split over a pool of worker processes.
+"""
+import os
+import glob
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from GTFS import ShapeGeometry
+
+# Arrays shared with a worker process, memory-mapped by open_shared
+SHARED = {}
+
+
+def group_starts(starts):
+    """
+    Position of the first row of the group of every row, for groups of consecutive rows
+
+    :param starts: bool array, True for the first row of every group
+    """
+    return np.maximum.accumulate(np.where(starts, np.arange(len(starts)), 0))
+
+
+def expand(counts):
+    """
+    Row of every generated element and its position within the row, for counts elements per row
+    """
+    counts = np.maximum(counts, 0)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    ends = np.cumsum(counts)
+    return rows, np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+
+
+def sorted_stop_times(trips, stoptimes):
+    """
+    The usable stop times (with a distance and an arrival) of the trips, ordered as the trips and
+    within a trip on stop_sequence
+
+    :return: Tuple of the stop times and the position of their trip in trips
+    """
+    order = pd.Series(np.arange(len(trips)), index=pd.Index(trips.trip_id))
+    st = stoptimes[stoptimes.trip_id.isin(order.index)]
+    st = st[st.shape_dist_traveled.notna() & st.arrival_time.notna()]
+    rank = order.reindex(st.trip_id).to_numpy()
+    arrangement = np.lexsort((st.stop_sequence.to_numpy(), rank))
+    return st.iloc[arrangement], rank[arrangement].astype(np.int64)
+
+
+def minutes(trip, arrival, departure, dist, step=1):
+    """
+    The minutes of trips at and between their stops, see trip_positions
+
+    :param trip: Trip of every stop time, the stop times of a trip are consecutive
+    :param arrival: Arrival in minutes since midnight per stop time
+    :param departure: Departure in minutes since midnight per stop time
+    :param dist: shape_dist_traveled per stop time
+    :param int step: Minutes between positions
+    :return: Tuple of the stop time, time, distance along the shape and sequence of every position
+    """
+    arrival = np.asarray(arrival, dtype=np.int64)
+    departure = np.asarray(departure, dtype=np.int64)
+    dist = np.asarray(dist, dtype=float)
+    first = np.concatenate([[True], trip[1:] != trip[:-1]]) if len(trip) else np.array([], dtype=bool)
+    previous = np.maximum(np.arange(len(trip)) - 1, 0)
+
+    # A stop at the same distance as the previous one is moved 0.1 meter, which alternates within a
+    # run of equal distances; an arrival in the minute of the previous departure is moved a minute
+    same = ~first & (dist == dist[previous])
+    dist = dist + 0.1 * ((np.arange(len(trip)) - group_starts(~same)) % 2)
+    last_departure = np.where(first, -1, departure[previous])
+    last_dist = np.where(first, -1, dist[previous])
+    arrival = arrival + (arrival == last_departure)
+    travels = last_departure > 0
+
+    # Every travel and every dwell increments the sequence
+    increments = 1 + travels
+    sequence = np.cumsum(increments)
+    start = group_starts(first)
+    sequence = sequence - sequence[start] + increments[start]
+
+    # The minutes travelling to a stop come before the minutes at the stop
+    travelling = np.where(travels, np.maximum(arrival - last_departure - 1, 0), 0)
+    rows, offset = expand(travelling + np.maximum(departure - arrival + 1, 0))
+    dwelling = offset >= travelling[rows]
+    time = np.where(dwelling, arrival[rows] + offset - travelling[rows], last_departure[rows] + 1 + offset)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = (dist - last_dist) / (arrival - last_departure)
+    distance = np.floor(np.where(dwelling, dist[rows],
+                                 last_dist[rows] + (time - last_departure[rows]) * speed[rows]))
+    sequences = sequence[rows] - ~dwelling
+    if step > 1:
+        keep = time % step == 0
+        rows, time, distance, sequences = rows[keep], time[keep], distance[keep], sequences[keep]
+
+    return rows, time, distance, sequences
+
+
+def trip_positions(trips, stoptimes, geometry, step=1):
+    """
+    Position of every trip for every minute between its first arrival and last departure. While the
+    vehicle travels between two stops its distance along the shape is interpolated linearly in time, it
+    carries the next stop; while it dwells at a stop it is at the stop. Every travel and every dwell
+    gets a new sequence number within the trip.
+
+    :param trips: Frame with trip_id, trip_short_name and shape_id of the trips
+    :param stoptimes: Frame with trip_id, stop_sequence, stop_id, arrival_time and departure_time (minutes
+                      since midnight) and shape_dist_traveled, may hold other trips
+    :param ShapeGeometry geometry: The shapes
+    :param int step: Minutes between positions, times that are a multiple of step are kept
+    :return: Frame with trip_id, ritnumber, sequence, time, stop_id, lat and lon, ordered as trips and
+             within a trip on time
+    """
+    st, trip = sorted_stop_times(trips, stoptimes)
+    rows, time, distance, sequences = minutes(trip, st.arrival_time.to_numpy(), st.departure_time.to_numpy(),
+                                              st.shape_dist_traveled.to_numpy(), step)
+    lat, lon = geometry.interpolate(trips.shape_id.to_numpy()[trip[rows]], distance)
+    return positions_frame(trips, st, trip, rows, time, sequences, lat, lon)
+
+
+def positions_frame(trips, st, trip, rows, time, sequences, lat, lon):
+    """
+    Frame of the positions of the stop times rows of the sorted stop times
+    """
+    trips = trips.iloc[trip[rows]]
+    return pd.DataFrame({'trip_id': trips.trip_id.to_numpy(), 'ritnumber': trips.trip_short_name.to_numpy(),
+                         'sequence': sequences, 'time': time, 'stop_id': st.stop_id.to_numpy()[rows],
+                         'lat': lat, 'lon': lon})
+
+
+def partition(trip, parts):
+    """
+    Bounds of about equal parts of the sorted stop times, parts only start at the first stop of a trip
+    """
+    starts = np.flatnonzero(np.concatenate([[True], trip[1:] != trip[:-1]])) if len(trip) else np.array([0])
+    targets = np.linspace(0, len(trip), parts + 1)[1:-1]
+    return np.unique(np.concatenate([[0], starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)],
+                                     [len(trip)]]))
+
+
+def open_shared(directory):
+    """
+    Memory-map the arrays written by parallel_trip_positions, initializer of the worker processes
+    """
+    SHARED.clear()
+    for filename in glob.glob(os.path.join(directory, '*.npy')):
+        SHARED[os.path.basename(filename)[:-4]] = np.load(filename, mmap_mode='r')
+    SHARED['geometry'] = ShapeGeometry.from_arrays({name[6:]: values for name, values in SHARED.items()
+                                                    if name.startswith('shape_')})
+
+
+def positions_part(start, end, step):
+    """
+    Positions of the stop times start to end of the shared arrays, runs in a worker process
+    """
+    part = slice(start, end)
+    rows, time, distance, sequences = minutes(np.asarray(SHARED['trip'][part]), SHARED['arrival'][part],
+                                              SHARED['departure'][part], SHARED['dist'][part], step)
+    geometry = SHARED['geometry']
+    shape = np.asarray(SHARED['shape'][part])[rows]
+    lat, lon = geometry.interpolate(geometry.shape_ids[np.maximum(shape, 0)], distance)
+    lat[shape < 0], lon[shape < 0] = np.nan, np.nan
+    return rows + start, time, sequences, lat, lon
+
+
+def parallel_trip_positions(trips, stoptimes, geometry, step=1, workers=None, directory=None):
+    """
+    Positions of the trips as trip_positions, computed by a pool of worker processes. The sorted stop
+    times and the shape geometry are written once as .npy files that the workers memory-map, the tasks
+    only hold the bounds of a part of the trips. The parts are merged in trip order, so the result is
+    the same as that of trip_positions for any number of workers.
+
+    :param int workers: Number of worker processes, defaults to the number of CPUs
+    :param str directory: Directory for the shared arrays, defaults to the system temporary directory
+    :return: See trip_positions
+    """
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        return trip_positions(trips, stoptimes, geometry, step)
+    st, trip = sorted_stop_times(trips, stoptimes)
+    arrays = {'trip': trip, 'arrival': st.arrival_time.to_numpy(dtype=np.int64),
+              'departure': st.departure_time.to_numpy(dtype=np.int64),
+              'dist': st.shape_dist_traveled.to_numpy(dtype=float),
+              'shape': geometry.shape_ids.get_indexer(pd.Index(trips.shape_id))[trip]}
+    for name, values in geometry.arrays().items():
+        arrays['shape_' + name] = values.astype(str) if values.dtype == object else values
+
+    # Forked workers do not import the calling script again
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    with tempfile.TemporaryDirectory(dir=directory) as shared:
+        for name, values in arrays.items():
+            np.save(os.path.join(shared, name + '.npy'), np.asarray(values))
+        bounds = partition(trip, workers * 4)
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=open_shared, initargs=(shared,)) as pool:
+            parts = list(pool.map(positions_part, bounds[:-1], bounds[1:], repeat(step)))
+    rows, time, sequences, lat, lon = (np.concatenate(values) for values in zip(*parts)) if parts else \
+        (np.array([], dtype=np.int64),) * 5
+    return positions_frame(trips, st, trip, rows, time, sequences, lat, lon)
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from threading import Lock
+from GTFS import epoch_to_datetime
+
+# Realtime feeds with stop time updates and the frame holding their rows
+PUNCTUALITY_FEEDS = {'tripUpdates': 'trip_updates', 'trainUpdates': 'train_updates'}
+
+# Dimensions the statistics are kept for
+DIMENSIONS = ['stop_id', 'route_id', 'agency_id', 'hour']
+
+# Edges in seconds of the delay histogram the percentiles are taken from, below the first edge and from
+# the last edge on are an underflow and an overflow bin
+DELAY_BINS = np.arange(-300, 3601, 30)
+HISTOGRAM = ['bin_{}'.format(i) for i in range(len(DELAY_BINS) + 1)]
+
+# Counters kept per group: stop events, events with an observed delay, sum of these delays, events on
+# time and cancelled events
+COUNTERS = ['stops', 'observed', 'delay_sum', 'on_time', 'cancelled']
+
+
+class GTFSPunctuality:
+    """
+    Rolling-window punctuality statistics per stop, route, agency and hour of the day, kept up to date
+    from the trip updates and train updates.
+    A stop event is counted once, when its (realtime) departure time has passed. The counters and a delay
+    histogram of the new events are aggregated per time bucket and added to running totals, buckets that
+    fall out of the window are subtracted again. Reading the statistics never scans the events.
+    """
+
+    def __init__(self, gtfs, window=timedelta(hours=24), bucket=timedelta(minutes=5), on_time=(-60, 180)):
+        """
+        :param GTFS gtfs: GTFS object with the static information loaded
+        :param timedelta window: Length of the rolling window
+        :param timedelta bucket: Resolution of the window
+        :param tuple on_time: Range of delays in seconds (inclusive) considered on time
+        """
+        self.gtfs = gtfs
+        self.window = window
+        self.bucket = bucket
+        self.on_time = on_time
+        self.lock = Lock()
+        # Aggregates of the events per bucket start and dimension, kept until the bucket expires
+        self.buckets = {}
+        self.totals = {dimension: empty_totals() for dimension in DIMENSIONS}
+        # Event time per key of the counted events in the window
+        self.seen = pd.Series(dtype='datetime64[us]', index=pd.Index([], dtype='uint64'))
+        self.cache = {}
+        self.now = None
+
+    def record(self, snapshot):
+        """
+        Count the passed stop events of a poller snapshot (see GTFSPoller), can be registered as
+        listener of the poller
+        """
+        if snapshot.feed in PUNCTUALITY_FEEDS:
+            self.update(snapshot.frames[PUNCTUALITY_FEEDS[snapshot.feed]],
+                        epoch_to_datetime([snapshot.timestamp])[0])
+
+    def events(self, df):
+        """
+        Stop events of a trip_updates or train_updates frame. Trip updates are matched with their
+        stop through the (trip_id, stop_sequence) index, train updates on (trip_id, stop_id). Cancelled
+        trips are expanded to all their planned stops, stops without a realtime time get the planned time.
+
+        :return: DataFrame with key, trip_id, stop_id, route_id, time, delay and cancelled
+        """
+        stoptimes = self.gtfs.stoptimes
+        relationship = df.schedule_relationship.to_numpy()
+        trips = df[relationship == 'CANCELED'].drop_duplicates(['trip_id', 'start_time'])
+        cancelled = trips[['trip_id', 'start_time', 'route_id']].merge(
+            stoptimes[['trip_id', 'stop_id', 'departure_time']], on='trip_id')
+        cancelled = cancelled.rename(columns={'departure_time': 'time'})
+        cancelled['delay'] = np.nan
+        cancelled['cancelled'] = True
+
+        df = df[relationship != 'CANCELED']
+        if 'stop_sequence' in df.columns:
+            positions = self.gtfs.trip_stop_index.lookup(df.trip_id, df.stop_sequence)
+            df = df[positions >= 0].assign(stop_id=stoptimes.stop_id.take(positions[positions >= 0]).to_numpy(),
+                                           planned=stoptimes.departure_time.take(positions[positions >= 0]).to_numpy())
+        else:
+            planned = stoptimes[['trip_id', 'stop_id', 'departure_time']].drop_duplicates(['trip_id', 'stop_id'])
+            df = df.merge(planned.rename(columns={'departure_time': 'planned'}), on=['trip_id', 'stop_id'], how='left')
+        time = df.departure_time.fillna(df.arrival_time)
+        delay = df.departure_delay.fillna(df.arrival_delay).astype(float)
+        delay = delay.fillna((time - df.planned).dt.total_seconds())
+        skipped = (df.schedule_relationship == 'SKIPPED').to_numpy()
+        updates = pd.DataFrame({'trip_id': df.trip_id.to_numpy(), 'start_time': df.start_time.to_numpy(),
+                                'route_id': df.route_id.to_numpy(), 'stop_id': df.stop_id.to_numpy(),
+                                'time': time.where(~skipped, df.planned).to_numpy(),
+                                'delay': delay.where(~skipped).to_numpy(), 'cancelled': skipped})
+
+        events = pd.concat([updates, cancelled], ignore_index=True).dropna(subset=['stop_id', 'time'])
+        events['key'] = pd.util.hash_pandas_object(events[['trip_id', 'start_time', 'stop_id']], index=False).to_numpy()
+        return events
+
+    def update(self, df, now):
+        """
+        Count the stop events of a trip_updates or train_updates frame that passed before now and were not
+        counted before, and expire the buckets that fell out of the window
+
+        :param df: trip_updates or train_updates frame
+        :param datetime now: Time of the feed
+        :return: Number of counted events
+        """
+        with self.gtfs.stage('aggregate:punctuality', rows_in=len(df)) as stage, self.lock:
+            start = now - self.window
+            events = self.events(df)
+            new = (events.time <= now) & (events.time > start) & ~events.key.isin(self.seen.index)
+            events = events[new.to_numpy()].drop_duplicates('key')
+            self.seen = pd.concat([self.seen[self.seen > start],
+                                   pd.Series(events.time.to_numpy(), index=events.key.to_numpy())])
+            if len(events):
+                self.add(events)
+            self.expire(start)
+            self.now = now
+            self.cache = {}
+            stage['rows_out'] = len(events)
+        return len(events)
+
+    def add(self, events):
+        """
+        Aggregate events per bucket and dimension and add them to the totals
+        """
+        events['agency_id'] = events.route_id.map(self.gtfs.routes.set_index('route_id').agency_id)
+        events['hour'] = events.time.dt.hour
+        events['bucket'] = events.time.dt.floor(self.bucket)
+        delay = events.delay.to_numpy()
+        observed = ~np.isnan(delay) & ~events.cancelled.to_numpy()
+        counters = pd.DataFrame({'stops': 1.0, 'observed': observed.astype(float),
+                                 'delay_sum': np.where(observed, delay, 0),
+                                 'on_time': (observed & (delay >= self.on_time[0]) & (delay <= self.on_time[1])),
+                                 'cancelled': events.cancelled.to_numpy(dtype=float)}, index=events.index)
+        histogram = np.zeros((len(events), len(HISTOGRAM)))
+        histogram[np.flatnonzero(observed), np.searchsorted(DELAY_BINS, delay[observed], side='right')] = 1
+        counters = counters.astype(float).join(pd.DataFrame(histogram, columns=HISTOGRAM, index=events.index))
+
+        for dimension in DIMENSIONS:
+            keys = [events.bucket, events[dimension].astype(object)]
+            aggregates = counters.groupby(keys, sort=False, dropna=True).sum()
+            for bucket, rows in aggregates.groupby(level=0, sort=False):
+                self.buckets.setdefault(bucket, {d: [] for d in DIMENSIONS})[dimension].append(rows.droplevel(0))
+            self.totals[dimension] = self.totals[dimension].add(
+                aggregates.groupby(level=1, sort=False).sum(), fill_value=0)
+
+    def expire(self, start):
+        """
+        Subtract the buckets that ended before the start of the window from the totals
+        """
+        for bucket in sorted(b for b in self.buckets if b + self.bucket <= start):
+            for dimension, frames in self.buckets.pop(bucket).items():
+                if not frames:
+                    continue
+                expired = pd.concat(frames).groupby(level=0, sort=False).sum()
+                totals = self.totals[dimension].sub(expired, fill_value=0)
+                self.totals[dimension] = totals[totals.stops > 0]
+
+    def statistics(self, dimension):
+        """
+        Punctuality per group of a dimension in the current window. The result is kept until the next
+        update, repeated reads are free.
+
+        :param str dimension: One of DIMENSIONS
+        :return: DataFrame indexed by the group with stops, mean_delay, p50, p90 and p95 (delays in
+                 seconds), on_time_share (of the observed stops) and cancelled_share
+        """
+        with self.lock:
+            if dimension not in self.cache:
+                self.cache[dimension] = punctuality(self.totals[dimension])
+            return self.cache[dimension]
+
+    def get(self, dimension, key):
+        """
+        Punctuality of one stop, route, agency or hour in the current window, None if there are no events
+
+        :param str dimension: One of DIMENSIONS
+        :param key: The stop_id, route_id, agency_id or hour
+        :return: Series, see statistics
+        """
+        statistics = self.statistics(dimension)
+        return statistics.loc[key] if key in statistics.index else None
+
+    def summary(self):
+        """
+        Punctuality of all stop events in the current window, see statistics
+        """
+        with self.lock:
+            if 'summary' not in self.cache:
+                totals = self.totals['hour'].sum().to_frame().T
+                self.cache['summary'] = punctuality(totals.astype(float)).iloc[0]
+            return self.cache['summary']
+
+
+def empty_totals():
+    """
+    Totals without groups
+    """
+    return pd.DataFrame(columns=COUNTERS + HISTOGRAM, dtype=float)
+
+
+def punctuality(totals):
+    """
+    Statistics from totals: mean delay, the delay percentiles from the cumulative histogram (upper edge
+    of the bin holding the percentile), the share of the observed stops on time and the share cancelled
+    """
+    observed = totals.observed.to_numpy()
+    cumulative = totals[HISTOGRAM].to_numpy().cumsum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df = pd.DataFrame({'stops': totals.stops.to_numpy().astype(np.int64),
+                           'mean_delay': totals.delay_sum.to_numpy() / observed}, index=totals.index)
+        for q in [50, 90, 95]:
+            bins = (cumulative < observed[:, None] * q / 100).sum(axis=1)
+            df['p{}'.format(q)] = np.where(observed > 0, DELAY_BINS[np.minimum(bins, len(DELAY_BINS) - 1)], np.nan)
+        df['on_time_share'] = totals.on_time.to_numpy() / observed
+        df['cancelled_share'] = totals.cancelled.to_numpy() / totals.stops.to_numpy()
+    return df
@@ -0,0 +1,268 @@
+"""
+Generator for synthetic GTFS feeds shaped like gtfs-nl.zip and the OVapi realtime feeds, to run and
+benchmark the GTFS class without the live feeds.
+"""
+import os
+import io
+import zipfile
+import numpy as np
+import pandas as pd
+import gtfs_realtime_pb2
+import gtfs_realtime_OVapi_pb2
+from datetime import datetime, timedelta
+
+AGENCIES = ['NS', 'ARR', 'CXX', 'KEOLIS', 'SYNTUS']
+# Bounding box of the Netherlands (min_lon, min_lat, max_lon, max_lat)
+BBOX = (3.4, 50.75, 7.2, 53.5)
+
+
+def seconds_to_time(seconds):
+    """
+    Format seconds since the start of the service day as GTFS times (HH:MM:SS, may be past 24:00)
+    """
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return pd.Series(seconds // 3600).astype(str).str.zfill(2) + ':' + \
+        pd.Series(seconds // 60 % 60).astype(str).str.zfill(2) + ':' + \
+        pd.Series(seconds % 60).astype(str).str.zfill(2)
+
+
+def distances(lon, lat):
+    """
+    Cumulative distance in meters along a polyline
+    """
+    dx = np.diff(lon) * 111320 * np.cos(np.radians(52.1))
+    dy = np.diff(lat) * 110574
+    return np.concatenate([[0], np.cumsum(np.hypot(dx, dy))])
+
+
+def generate_static(filename='gtfs-nl.zip', stations=1000, routes=200, trips=5000, stops_per_trip=20,
+                    points_per_shape=200, day=None, days=7, seed=1):
+    """
+    Write a synthetic static GTFS feed. Every station has two platforms, every route runs along its own
+    shape through stops_per_trip platforms and every trip follows the stops of its route.
+
+    :param str filename: The zip file to write
+    :param int stations: Number of stations (stops.txt holds three rows per station)
+    :param int routes: Number of routes (and shapes)
+    :param int trips: Number of trips
+    :param int stops_per_trip: Number of stops per trip
+    :param int points_per_shape: Number of points per shape
+    :param str day: First service day as YYYY-MM-DD, defaults to today
+    :param int days: Number of service days
+    :param int seed: Seed of the random generator
+    :return: Dictionary with the generated tables
+    """
+    rng = np.random.default_rng(seed)
+    first = datetime.strptime(day, '%Y-%m-%d') if day else datetime.now().replace(hour=0, minute=0, second=0,
+                                                                                  microsecond=0)
+    tables = {}
+
+    tables['agency.txt'] = pd.DataFrame({'agency_id': ['IFF:' + a for a in AGENCIES], 'agency_name': AGENCIES,
+                                         'agency_url': 'http://www.example.com', 'agency_timezone': 'Europe/Amsterdam'})
+
+    lon = rng.uniform(BBOX[0], BBOX[2], stations)
+    lat = rng.uniform(BBOX[1], BBOX[3], stations)
+    names = np.array(['Station {:05d}'.format(i) for i in range(stations)], dtype=object)
+    station_rows = pd.DataFrame({'stop_id': ['stoparea:{}'.format(i) for i in range(stations)],
+                                 'stop_code': ['S{:05d}'.format(i) for i in range(stations)], 'stop_name': names,
+                                 'stop_lat': lat, 'stop_lon': lon, 'location_type': 1, 'parent_station': None,
+                                 'platform_code': None, 'zone_id': ['IFF:S{:05d}'.format(i) for i in range(stations)]})
+    platform_station = np.repeat(np.arange(stations), 2)
+    platform_rows = pd.DataFrame({'stop_id': [str(1000000 + i) for i in range(2 * stations)],
+                                  'stop_code': station_rows.stop_code.values[platform_station],
+                                  'stop_name': names[platform_station],
+                                  'stop_lat': lat[platform_station] + rng.normal(0, 0.0002, 2 * stations),
+                                  'stop_lon': lon[platform_station] + rng.normal(0, 0.0002, 2 * stations),
+                                  'location_type': 0,
+                                  'parent_station': station_rows.stop_id.values[platform_station],
+                                  'platform_code': np.tile(['1', '2'], stations),
+                                  'zone_id': station_rows.zone_id.values[platform_station]})
+    tables['stops.txt'] = pd.concat([station_rows, platform_rows], ignore_index=True)
+
+    agency = rng.integers(0, len(AGENCIES), routes)
+    tables['routes.txt'] = pd.DataFrame({'route_id': np.arange(routes) + 1,
+                                         'agency_id': ['IFF:' + AGENCIES[a] for a in agency],
+                                         'route_short_name': ['Lijn {}'.format(i + 1) for i in range(routes)],
+                                         'route_long_name': ['Route {}'.format(i + 1) for i in range(routes)],
+                                         'route_type': np.where(agency == 0, 2, 3)})
+
+    # Every route visits a random walk of nearby stations, its shape runs through their first platform
+    shapes = []
+    route_stops = []
+    route_dists = []
+    for r in range(routes):
+        visits = [rng.integers(stations)]
+        for _ in range(stops_per_trip - 1):
+            d = (lon - lon[visits[-1]]) ** 2 + (lat - lat[visits[-1]]) ** 2
+            d[visits] = np.inf
+            visits.append(np.argsort(d)[rng.integers(0, 3)])
+        platforms = 2 * np.array(visits)
+        plon = platform_rows.stop_lon.values[platforms]
+        plat = platform_rows.stop_lat.values[platforms]
+        # Interpolate the shape points between the stops
+        pos = np.linspace(0, stops_per_trip - 1, max(points_per_shape, stops_per_trip))
+        pos = np.union1d(pos, np.arange(stops_per_trip))
+        slon = np.interp(pos, np.arange(stops_per_trip), plon)
+        slat = np.interp(pos, np.arange(stops_per_trip), plat)
+        dist = distances(slon, slat)
+        shapes.append(pd.DataFrame({'shape_id': r + 1, 'shape_pt_sequence': np.arange(len(pos)) + 1,
+                                    'shape_pt_lat': slat, 'shape_pt_lon': slon,
+                                    'shape_dist_traveled': dist.astype(np.int64)}))
+        route_stops.append(platforms)
+        route_dists.append(dist[np.searchsorted(pos, np.arange(stops_per_trip))])
+    tables['shapes.txt'] = pd.concat(shapes, ignore_index=True)
+
+    services = 7
+    dates = [first + timedelta(days=d) for d in range(days)]
+    tables['calendar_dates.txt'] = pd.DataFrame(
+        [{'service_id': s + 1, 'date': d.strftime('%Y%m%d'), 'exception_type': 1}
+         for s in range(services) for d in dates if s == 0 or d.weekday() != s - 1])
+
+    route = rng.integers(0, routes, trips)
+    tables['trips.txt'] = pd.DataFrame({'route_id': route + 1, 'service_id': rng.integers(1, services + 1, trips),
+                                        'trip_id': np.arange(trips) + 1,
+                                        'trip_headsign': ['Station {:05d}'.format(route_stops[r][-1] // 2)
+                                                          for r in route],
+                                        'trip_short_name': np.arange(trips) + 1,
+                                        'trip_long_name': np.where(agency[route] == 0, 'Intercity', 'Bus'),
+                                        'direction_id': rng.integers(0, 2, trips), 'shape_id': route + 1})
+
+    # Departure from the first stop between 05:00 and 25:00, 60 km/h plus a dwell time of 30 seconds
+    start = rng.integers(5 * 3600, 25 * 3600, trips)
+    dist = np.stack([route_dists[r] for r in route])
+    arrival = start[:, None] + (dist / (60 / 3.6)).astype(np.int64) + 30 * np.arange(stops_per_trip)
+    departure = arrival + np.where(np.arange(stops_per_trip) < stops_per_trip - 1, 30, 0)
+    tables['stop_times.txt'] = pd.DataFrame({
+        'trip_id': np.repeat(np.arange(trips) + 1, stops_per_trip),
+        'stop_sequence': np.tile(np.arange(stops_per_trip) + 1, trips),
+        'stop_id': platform_rows.stop_id.values[np.stack([route_stops[r] for r in route]).ravel()],
+        'stop_headsign': None,
+        'arrival_time': seconds_to_time(arrival.ravel()).values,
+        'departure_time': seconds_to_time(departure.ravel()).values,
+        'shape_dist_traveled': dist.ravel().astype(np.int64)})
+
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, df in tables.items():
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False)
+            z.writestr(name, buffer.getvalue())
+    return tables
+
+
+def generate_realtime(tables, directory='.', day=None, share=0.5, alerts=50, seed=1, timestamp=None,
+                      cancelled=0.02, skipped=0.01):
+    """
+    Write synthetic realtime feeds (tripUpdates.pb, trainUpdates.pb, vehiclePositions.pb and alerts.pb)
+    for trips of a feed made by generate_static, including the OVapi extensions.
+
+    :param dict tables: The tables returned by generate_static
+    :param str directory: Directory to write the feeds to
+    :param str day: Service day as YYYY-MM-DD, defaults to today
+    :param float share: Share of the trips with realtime information
+    :param int alerts: Number of alerts
+    :param int seed: Seed of the random generator, use another seed for changed feeds
+    :param int timestamp: Feed timestamp, defaults to now
+    :param float cancelled: Share of the trips with realtime information that are cancelled
+    :param float skipped: Share of the stops of the other trips that are skipped
+    """
+    rng = np.random.default_rng(seed)
+    day = datetime.strptime(day, '%Y-%m-%d') if day else datetime.now()
+    base = int(pd.Timestamp(day.strftime('%Y-%m-%d') + ' 12:00', tz='Europe/Amsterdam').timestamp()) - 12 * 3600
+    timestamp = timestamp or int(datetime.now().timestamp())
+    trips = tables['trips.txt']
+    routes = tables['routes.txt'].set_index('route_id')
+    stoptimes = tables['stop_times.txt']
+    stops = tables['stops.txt'].set_index('stop_id')
+    per_trip = stoptimes.groupby('trip_id')
+    selected = trips[rng.random(len(trips)) < share]
+
+    def feed():
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.header.gtfs_realtime_version = '1.0'
+        message.header.timestamp = timestamp
+        return message
+
+    trip_updates, train_updates, vehicle_positions = feed(), feed(), feed()
+    for trip in selected.itertuples():
+        times = per_trip.get_group(trip.trip_id)
+        seconds = times.departure_time.str.split(':', expand=True).astype(int) @ np.array([3600, 60, 1])
+        delay = int(rng.integers(-60, 600))
+        train = routes.agency_id[trip.route_id] == 'IFF:NS'
+        entity = (train_updates if train else trip_updates).entity.add()
+        entity.id = str(trip.trip_id) if train else '{}:{}'.format(day.strftime('%Y%m%d'), trip.trip_id)
+        descriptor = entity.trip_update.trip
+        if not train:
+            descriptor.trip_id = str(trip.trip_id)
+        descriptor.route_id = str(trip.route_id)
+        descriptor.direction_id = int(trip.direction_id)
+        descriptor.start_date = day.strftime('%Y%m%d')
+        descriptor.start_time = times.departure_time.iloc[0]
+        ovapi = descriptor.Extensions[gtfs_realtime_OVapi_pb2.ovapi_tripdescriptor]
+        ovapi.realtime_trip_id = 'RT:{}'.format(trip.trip_id)
+        ovapi.trip_short_name = str(trip.trip_short_name)
+        entity.trip_update.vehicle.label = 'V{}'.format(trip.trip_id)
+        entity.trip_update.timestamp = timestamp
+        # Cancelled trips list their stops in the train updates only and have no vehicle
+        cancel = rng.random() < cancelled
+        if cancel:
+            descriptor.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.CANCELED
+        for st, secs in zip(times.itertuples(), seconds):
+            if cancel and not train:
+                break
+            update = entity.trip_update.stop_time_update.add()
+            if train:
+                update.stop_id = st.stop_id
+                extension = update.Extensions[gtfs_realtime_OVapi_pb2.ovapi_stop_time_update]
+                extension.scheduled_track = str(stops.platform_code[st.stop_id])
+                extension.station_id = str(stops.stop_code[st.stop_id])
+            else:
+                update.stop_sequence = st.stop_sequence
+            if cancel:
+                continue
+            if rng.random() < skipped:
+                update.schedule_relationship = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+                continue
+            for event in [update.arrival, update.departure]:
+                event.time = base + int(secs) + delay
+                event.delay = delay
+        if cancel:
+            continue
+
+        vehicle = vehicle_positions.entity.add()
+        vehicle.id = 'V{}'.format(trip.trip_id)
+        position = vehicle.vehicle
+        position.trip.trip_id = str(trip.trip_id)
+        position.trip.route_id = str(trip.route_id)
+        position.trip.start_date = day.strftime('%Y%m%d')
+        position.trip.start_time = times.departure_time.iloc[0]
+        position.trip.Extensions[gtfs_realtime_OVapi_pb2.ovapi_tripdescriptor].realtime_trip_id = \
+            'RT:{}'.format(trip.trip_id)
+        current = times.iloc[int(rng.integers(len(times)))]
+        position.position.latitude = stops.stop_lat[current.stop_id] + rng.normal(0, 0.001)
+        position.position.longitude = stops.stop_lon[current.stop_id] + rng.normal(0, 0.001)
+        position.current_stop_sequence = int(current.stop_sequence)
+        position.timestamp = timestamp
+        position.vehicle.label = 'V{}'.format(trip.trip_id)
+        position.Extensions[gtfs_realtime_OVapi_pb2.ovapi_vehicle_position].delay = delay
+
+    alert_feed = feed()
+    for a in range(alerts):
+        entity = alert_feed.entity.add()
+        entity.id = 'alert:{}'.format(a)
+        alert = entity.alert
+        alert.cause = int(rng.integers(1, 13))
+        alert.effect = int(rng.integers(1, 10))
+        alert.header_text.translation.add().text = 'Melding {}'.format(a)
+        alert.description_text.translation.add().text = 'Beschrijving van melding {}'.format(a)
+        period = alert.active_period.add()
+        period.start = timestamp - int(rng.integers(0, 7200))
+        period.end = timestamp + int(rng.integers(0, 7200))
+        for _ in range(int(rng.integers(1, 4))):
+            informed = alert.informed_entity.add()
+            informed.stop_id = str(rng.choice(stoptimes.stop_id.values))
+            informed.route_id = str(rng.choice(routes.index.values))
+
+    for name, message in [('tripUpdates', trip_updates), ('trainUpdates', train_updates),
+                          ('vehiclePositions', vehicle_positions), ('alerts', alert_feed)]:
+        with open(os.path.join(directory, name + '.pb'), 'wb') as f:
+            f.write(message.SerializeToString())
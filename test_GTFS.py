@@ -0,0 +1,48 @@
+"""
+Regression tests of the GTFS class on a synthetic feed, run with pytest
+"""
+import pandas as pd
+import gtfs_realtime_pb2
+import GTFSSynthetic
+from datetime import datetime
+from GTFS import GTFS
+
+DAY = '2026-10-19'
+
+
+def test_timeline_delayed_first_departure(tmp_path, monkeypatch):
+    """
+    A delayed first departure must not push out a later planned departure that leaves before it
+    """
+    monkeypatch.chdir(tmp_path)
+    GTFSSynthetic.generate_static('gtfs-nl.zip', day=DAY, stations=20, routes=5, trips=600, stops_per_trip=5,
+                                  points_per_shape=10)
+    gtfs = GTFS(verbose=False)
+    gtfs.update_static(DAY)
+    after = datetime.strptime(DAY, '%Y-%m-%d').replace(hour=8)
+
+    # The stop with the most departures in the half hour after 08:00
+    timeline = gtfs.timeline
+    window = timeline[(timeline.departure_time > after) & (timeline.departure_time <= after + pd.Timedelta('30min'))]
+    stop_id = window.stop_id.astype(str).value_counts().index[0]
+    planned = gtfs.get_timeline([stop_id], after=after, n=3)
+    assert len(planned) == 3 and planned.departure_time.iloc[2] < after + pd.Timedelta('30min')
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    feed.header.timestamp = int(after.timestamp())
+    entity = feed.entity.add()
+    entity.id = 'delayed'
+    entity.trip_update.trip.trip_id = str(planned.trip_id.iloc[0])
+    entity.trip_update.trip.start_date = DAY.replace('-', '')
+    entity.trip_update.trip.start_time = '08:00:00'
+    update = entity.trip_update.stop_time_update.add()
+    update.stop_sequence = int(planned.stop_sequence.iloc[0])
+    update.departure.delay = 1800
+    gtfs.apply_feed('tripUpdates', feed)
+
+    expected = gtfs.get_timeline([stop_id], after=after).head(2)
+    actual = gtfs.get_timeline([stop_id], after=after, n=2)
+    assert actual.trip_id.astype(str).tolist() == expected.trip_id.astype(str).tolist()
+    assert actual.departure_time.tolist() == expected.departure_time.tolist()
+    assert str(planned.trip_id.iloc[0]) not in actual.trip_id.astype(str).tolist()